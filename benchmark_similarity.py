@@ -0,0 +1,89 @@
+"""Compare exact similarity search with LSH for a few settings
+Run with `python benchmark_similarity.py` for a made up library of 50000 bookmarks,
+`python benchmark_similarity.py 200000` for a different size,
+or `python benchmark_similarity.py bookmarks.db` to use your own scraped descriptions"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from scipy import sparse
+from scripts.similarity_utils import SimilarityIndex, LSHIndex, TOP_K
+
+QUERIES = 200
+# (bits, candidates)
+SETTINGS = [
+    (128, 200),
+    (128, 500),
+    (256, 200),
+    (256, 500),
+    (256, 1000),
+    (512, 500),
+    (512, 1000),
+]
+
+
+def synthetic_index(n, vocabulary=20000, topics=200, words_per_page=150, seed=0):
+    """An index of pages that each mostly use the words of one topic"""
+    rng = np.random.default_rng(seed)
+    topic_words = [rng.choice(vocabulary, 300, replace=False) for _ in range(topics)]
+    rows, columns = [], []
+    for row in range(n):
+        topic = topic_words[rng.integers(topics)]
+        # Mostly topic words with some noise
+        words = np.concatenate([rng.choice(topic, int(words_per_page * 0.8)), rng.integers(vocabulary, size=int(words_per_page * 0.2))])
+        rows.append(np.full(len(words), row))
+        columns.append(words)
+    rows = np.concatenate(rows)
+    columns = np.concatenate(columns)
+    counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(n, vocabulary))
+    counts.sum_duplicates()
+
+    index = SimilarityIndex(os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    index.counts = counts
+    index.bookmark_ids = np.arange(1, n + 1, dtype=np.int64)
+    index.rows = {bookmark_id: row for row, bookmark_id in enumerate(index.bookmark_ids.tolist())}
+    return index
+
+def database_index(db_path):
+    """The similarity index for a real database"""
+    from scripts.similarity_utils import get_similarity_index
+    index = get_similarity_index(db_path)
+    index.wait()
+    return index
+
+def main():
+    argument = sys.argv[1] if len(sys.argv) > 1 else '50000'
+    if argument.isdigit():
+        print(f"Building a synthetic index of {argument} bookmarks")
+        index = synthetic_index(int(argument))
+    else:
+        index = database_index(argument)
+
+    vectors = index.get_vectors()
+    n = vectors.shape[0]
+    print(f"{n} bookmarks, {vectors.shape[1]} terms")
+    queries = np.random.default_rng(1).choice(index.bookmark_ids, min(QUERIES, n), replace=False).tolist()
+
+    # Exact search is the ground truth
+    start = time.perf_counter()
+    truth = {bookmark_id: {result[0] for result in index.similar(bookmark_id, exact=True)} for bookmark_id in queries}
+    exact_time = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"{'exact':<24}{'recall@' + str(TOP_K):<12}{1.0:<10.3f}{exact_time:.2f} ms/query")
+
+    for bits, candidates in SETTINGS:
+        index.lsh = LSHIndex(index.db_path, bits=bits, candidates=candidates)
+        start = time.perf_counter()
+        index.lsh.build(vectors)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = {bookmark_id: {result[0] for result in index.similar(bookmark_id, exact=False)} for bookmark_id in queries}
+        query_time = (time.perf_counter() - start) / len(queries) * 1000
+
+        recall = np.mean([len(results[q] & truth[q]) / len(truth[q]) for q in queries if truth[q]])
+        label = f"lsh {bits} bits {candidates}"
+        print(f"{label:<24}{'':<12}{recall:<10.3f}{query_time:.2f} ms/query (built in {build_time:.1f}s)")
+
+if __name__ == '__main__':
+    main()
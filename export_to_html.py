@@ -6,7 +6,9 @@ database = db.Database()
 database.open_database()
 
 # Now query to get bookmarks joined to descriptions table and ordered by date
-query = """SELECT * FROM bookmarks
+query = """SELECT bookmarks.id, title, url, add_date, folder,
+           descriptions.id, content, relevant_content, description, tags
+           FROM bookmarks
            JOIN descriptions
            ON bookmarks.id = descriptions.bookmark_id
            ORDER BY add_date DESC"""
@@ -3,8 +3,8 @@ import curses
 import logging
 import atexit
 from datetime import datetime
-from time import sleep
 from scripts.states import StateSetup
+from scripts import event_utils
 
 @atexit.register
 def cleanup():
@@ -24,6 +24,12 @@ def curses_init():
     curses.curs_set(0)
     stdscr.nodelay(True)
     stdscr.keypad(True)
+    # Let curses use the terminal's insert and delete line to move things up and down
+    stdscr.idlok(True)
+    # Curses waits a whole second after escape to see if it's the start of a key sequence, which made Back feel slow
+    curses.set_escdelay(25)
+    # Redraw as soon as the terminal is resized rather than when the wait times out
+    event_utils.watch_resize()
 
     return stdscr
 
@@ -49,38 +55,56 @@ def main():
     stdscr = curses_init()
     # Setup state
     state = StateSetup(stdscr)
-    sleep_interval = 0.1
+    redraw = True
     while True:
-        # Update and draw states
-        try:
-            # Update function can return a new state to switch to
-            new_state = state.update()
-            if new_state is not None:
-                state = new_state
-                logging.info(f"Switching to state: {state.__class__.__name__}")
-        except Exception as e:
-            logging.warning(f"State failed to update: {state.__class__.__name__}")
-            logging.warning(e)
-            exit(1)
-
-
-        # Clear the screen
-        stdscr.clear()
-
-        try:
-            state.render()
-        except Exception as e:
-            # Do no uncomment these unless needed cause they have the tendancy to spam the log file
-            # Basically because Curses is a little bitch and whines when you overflow even if you DON'T overflow
-            # logging.warning(f"State failed to render: {state.__class__.__name__}")
-            # logging.warning(e)
-            exit(1)
-
-        # Refresh the screen
-        stdscr.refresh()
-        curses.doupdate()
-
-        sleep(sleep_interval)
+        # Only draw when something has changed
+        if redraw or state.dirty:
+            # Erase rather than clear, clear makes curses repaint the whole terminal
+            stdscr.erase()
+
+            try:
+                state.render()
+                # Work out the new screen then send only the cells that changed in one go
+                stdscr.noutrefresh()
+                state.refresh()
+            except Exception as e:
+                # Do no uncomment these unless needed cause they have the tendancy to spam the log file
+                # Basically because Curses is a little bitch and whines when you overflow even if you DON'T overflow
+                # logging.warning(f"State failed to render: {state.__class__.__name__}")
+                # logging.warning(e)
+                exit(1)
+
+            curses.doupdate()
+            state.dirty = False
+
+        # Sleep until there's a key press, a background job wakes us or the state's timeout is up
+        event_utils.wait(state.timeout)
+
+        # Handle every key that's waiting, then one more update with no key for background work
+        redraw = False
+        while True:
+            key = stdscr.getch()
+            # Everything needs repainting after a resize
+            if key == curses.KEY_RESIZE:
+                stdscr.clearok(True)
+            # Update and draw states
+            try:
+                # Update function can return a new state to switch to
+                new_state = state.update(key)
+                if new_state is not None:
+                    state = new_state
+                    redraw = True
+                    logging.info(f"Switching to state: {state.__class__.__name__}")
+            except Exception as e:
+                logging.warning(f"State failed to update: {state.__class__.__name__}")
+                logging.warning(e)
+                exit(1)
+
+            if key != -1:
+                redraw = True
+            # A state we've just switched to gets an update straight away so its on_regress callback runs
+            elif new_state is None:
+                break
 
 
 if __name__ == '__main__':
@@ -1,68 +1,103 @@
-import re
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 from datetime import datetime
-import sqlite3
 import logging
 
-def read_bookmarks_html(file_path):
-    """Reads the bookmarks html file and returns the contents as a string"""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+# How much of the export to read at a time
+CHUNK_SIZE = 1024 * 1024
 
-def make_soup(html):
-    """Makes a BeautifulSoup object from the html"""
-    soup = BeautifulSoup(html, 'html.parser')
-    # Add the dummy h3 to the end of the soup
-    # We parse by getting the content between h3 tags so we need a dummy h3 at the end
-    soup.append(BeautifulSoup('<h3>dummy</h3>', 'html.parser'))
-    return soup
+class BookmarksParser(HTMLParser):
+    """Single pass, event driven parser for the bookmarks html that Chrome exports
+    The format is a Netscape bookmark file:
+    folders are <DT><H3>name</H3> followed by a <DL> holding their contents, and can be nested
+    bookmarks are <DT><A HREF="url" ADD_DATE="unix time">title</A>"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # One (folder name, folder path, path for subfolders) per open <DL>
+        # The path is a tuple of folder names from the top, the <H1> root isn't part of it
+        # but the bookmarks directly in the root get a top level folder named after it
+        self.folders = []
+        # The last heading we saw, this names the next <DL>
+        self.heading = None
+        self.heading_tag = None
+        # Text and attributes of the tag we're in the middle of
+        self.text = None
+        self.anchor = None
+        # Bookmarks parsed but not yet handed out
+        self.bookmarks = []
+        # Folders with bookmarks we couldn't parse
+        self.failures = []
 
-def parse_folders(soup):
-    """Gets all the bookmark folders and their contents
-    returns: dictionary of folders and their html contents, list of failures
-    """
-    # NOTE: I don't use subfolders, I'm not sure how Chrome handles them in the html
-    # Find h3 tags
-    h3_tags = soup.find_all('h3')
-    bookmarks = {}
-    failures = []
-    for i in range(0, len(h3_tags)-1):
-        heading = h3_tags[i].text
-        # Make pattern to find content between h3 tags
-        pattern = re.compile(r'{}(.+?){}'.format(re.escape(str(h3_tags[i])), re.escape(str(h3_tags[i + 1]))), re.DOTALL)
+    def stream(self, bookmarks_filepath):
+        """Yields (title, url, add_date, folder, folder_path) tuples, reading the file a chunk at a time"""
+        with open(bookmarks_filepath, 'r', encoding='utf-8') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.feed(chunk)
+                yield from self.drain()
+        self.close()
+        yield from self.drain()
 
-        try:
-            bookmarks[heading] = pattern.search(str(soup)).group(1).strip()
-        except AttributeError:
-            bookmarks[heading] = ''
-            failures.append(heading)
+    def drain(self):
+        """Hand out the bookmarks parsed so far"""
+        bookmarks = self.bookmarks
+        self.bookmarks = []
+        return bookmarks
 
-    return bookmarks, failures
+    def handle_starttag(self, tag, attrs):
+        if tag in ('h1', 'h3'):
+            self.text = []
+        elif tag == 'a':
+            self.text = []
+            self.anchor = dict(attrs)
+        elif tag == 'dl':
+            parent_name, parent_path, parent_base = self.folders[-1] if self.folders else (None, (), ())
+            if self.heading_tag == 'h3':
+                path = parent_base + (self.heading,)
+                self.folders.append((self.heading, path, path))
+            elif self.heading_tag == 'h1':
+                # The root list, its subfolders are still top level folders
+                self.folders.append((self.heading, parent_base + (self.heading,), parent_base))
+            else:
+                # A list without a heading (shouldn't happen) stays in the current folder
+                self.folders.append((parent_name, parent_path, parent_base))
+            self.heading = None
+            self.heading_tag = None
 
-def parse_bookmarks(bookmark_dict):
-    """Gets all the bookmarks from the bookmark folders
-    returns: list of tuples
-    """
-    bookmarks = []
-    for folder, html in bookmark_dict.items():
-        soup = BeautifulSoup(html, 'html.parser')
-        # Find all the a tags
-        a_tags = soup.find_all('a')
-        for a in a_tags:
-            title = a.text
-            url = a['href']
-            add_date = a['add_date']
-            # Convert add_date to datetime (it's in unix time)
-            add_date = datetime.fromtimestamp(int(add_date))
-            # Append the bookmark to the list
-            bookmarks.append((title, url, add_date, folder))
+    def handle_endtag(self, tag):
+        if tag in ('h1', 'h3') and self.text is not None:
+            self.heading = ''.join(self.text).strip()
+            self.heading_tag = tag
+            self.text = None
+        elif tag == 'a' and self.anchor is not None:
+            self.add_bookmark(''.join(self.text), self.anchor)
+            self.text = None
+            self.anchor = None
+        elif tag == 'dl' and self.folders:
+            self.folders.pop()
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
 
-    return bookmarks
+    def add_bookmark(self, title, attrs):
+        """Turn an anchor into a bookmark tuple"""
+        folder, folder_path, _ = self.folders[-1] if self.folders else (None, (), ())
+        try:
+            url = attrs['href']
+            # Convert add_date to datetime (it's in unix time)
+            add_date = datetime.fromtimestamp(int(attrs['add_date']))
+        except (KeyError, TypeError, ValueError):
+            logging.warning(f"Failed to parse bookmark: {title}")
+            if folder not in self.failures:
+                self.failures.append(folder)
+            return
+        self.bookmarks.append((title, url, add_date, folder, folder_path))
 
 def parse(bookmarks_filepath):
-    """Parses the bookmarks file and exports to a database
-    Returns any bookmark folders that failed to parse"""
-    soup = make_soup(read_bookmarks_html(bookmarks_filepath))
-    bookmarks, failures = parse_folders(soup)
-    bookmarks = parse_bookmarks(bookmarks)
-    return bookmarks, failures
+    """Parses the bookmarks file
+    Returns a list of bookmark tuples and any bookmark folders that failed to parse"""
+    parser = BookmarksParser()
+    bookmarks = list(parser.stream(bookmarks_filepath))
+    return bookmarks, parser.failures
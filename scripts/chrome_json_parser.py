@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import sys
+import sqlite3
+import time
+from datetime import datetime
+from scripts.database_utils import Database, fingerprint_file
+
+# Chrome stores dates as microseconds since 1601-01-01, this many seconds before the unix epoch
+CHROME_EPOCH_OFFSET = 11644473600
+
+# Top level bookmarks go in the same folder as in an html export, which is named after its <H1>
+ROOT_FOLDER = 'Bookmarks'
+
+# How often the watcher looks at the file (seconds)
+WATCH_INTERVAL = 2
+
+
+class BookmarksReader():
+    """Reads the Bookmarks JSON file Chrome keeps in the profile directory
+    Produces the same (title, url, add_date, folder, folder_path) tuples as BookmarksParser
+    The roots are laid out the way Chrome exports them: the bookmarks bar and mobile bookmarks are folders,
+    "Other bookmarks" sits at the top level in the ROOT_FOLDER"""
+    def __init__(self):
+        # Folders with bookmarks we couldn't read
+        self.failures = []
+
+    def stream(self, bookmarks_filepath):
+        """Yields bookmark tuples, folders are walked depth first in the order Chrome shows them"""
+        with open(bookmarks_filepath, 'r', encoding='utf-8') as f:
+            roots = json.load(f).get('roots', {})
+
+        # Stack of (node, folder name, folder path)
+        stack = []
+        for key in reversed(('bookmark_bar', 'other', 'synced')):
+            root = roots.get(key)
+            if not root:
+                continue
+            if key == 'other':
+                stack.append((root, ROOT_FOLDER, (ROOT_FOLDER,)))
+            else:
+                stack.append((root, root.get('name'), (root.get('name'),)))
+
+        while stack:
+            node, folder, folder_path = stack.pop()
+            subfolders = []
+            for child in node.get('children', []):
+                if child.get('type') == 'folder':
+                    name = child.get('name')
+                    subfolders.append((child, name, folder_path + (name,)))
+                    continue
+                bookmark = self.read_bookmark(child, folder, folder_path)
+                if bookmark:
+                    yield bookmark
+            # Reversed so the first subfolder comes off the stack first
+            stack.extend(reversed(subfolders))
+
+    def read_bookmark(self, node, folder, folder_path):
+        """Turn a url node into a bookmark tuple"""
+        title = node.get('name', '')
+        try:
+            url = node['url']
+            # Whole seconds, same as the ADD_DATE in an html export
+            add_date = datetime.fromtimestamp(int(node['date_added']) // 1000000 - CHROME_EPOCH_OFFSET)
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            logging.warning(f"Failed to read bookmark: {title}")
+            if folder not in self.failures:
+                self.failures.append(folder)
+            return None
+        return (title, url, add_date, folder, folder_path)
+
+class BookmarksWatcher():
+    """Keeps the database in sync with Chrome's Bookmarks file
+    poll() is cheap, it only stats the file every WATCH_INTERVAL seconds
+    and only reads it when the mtime changes and the contents hash differently
+    The file is taken to be imported already, with sync=False changes only add new bookmarks"""
+    def __init__(self, bookmarks_filepath, db_path='bookmarks.db', sync=True, interval=WATCH_INTERVAL):
+        self.bookmarks_filepath = bookmarks_filepath
+        self.db_path = db_path
+        self.sync_mode = sync
+        self.interval = interval
+        self.mtime = os.stat(bookmarks_filepath).st_mtime_ns
+        self.fingerprint = fingerprint_file(bookmarks_filepath)
+        self.next_check = time.monotonic() + interval
+
+    def poll(self):
+        """Sync if the file has changed, returns the changes from sync_bookmarks or None"""
+        now = time.monotonic()
+        if now < self.next_check:
+            return None
+        self.next_check = now + self.interval
+
+        try:
+            mtime = os.stat(self.bookmarks_filepath).st_mtime_ns
+        except OSError:
+            return None
+        if mtime == self.mtime:
+            return None
+        self.mtime = mtime
+
+        # Chrome rewrites the file on every save even when nothing we care about changed
+        fingerprint = fingerprint_file(self.bookmarks_filepath)
+        if fingerprint == self.fingerprint:
+            return None
+        self.fingerprint = fingerprint
+        return self.sync()
+
+    def sync(self):
+        """Sync the database with the file"""
+        reader = BookmarksReader()
+        database = Database(db_path=self.db_path)
+        try:
+            if self.sync_mode:
+                changes = database.sync_bookmarks(reader.stream(self.bookmarks_filepath), source=self.bookmarks_filepath, fingerprint=self.fingerprint)
+            else:
+                database.export_bookmarks(reader.stream(self.bookmarks_filepath))
+                changes = None
+        except (OSError, ValueError) as e:
+            # Most likely caught Chrome halfway through writing, try again next time
+            logging.warning(f"Failed to sync Chrome bookmarks: {e}")
+            self.retry(database)
+            return None
+        except sqlite3.Error as e:
+            # Usually the database is locked by something else writing to it, try again next time
+            logging.warning(f"Failed to write Chrome bookmarks to the database: {e}")
+            self.retry(database)
+            return None
+        if len(reader.failures) > 0:
+            logging.warning(f'Bookmarks folders failed to read: {reader.failures}')
+        return changes
+
+    def retry(self, database):
+        """Forget the file we failed to sync so the next poll has another go"""
+        # The connection's persistent so don't leave half a sync in its transaction
+        if database.database_is_connected():
+            database.db.rollback()
+            database.close_database()
+        self.mtime = None
+        self.fingerprint = None
+
+def get_chrome_bookmarks_path(profile='Default'):
+    """Returns where Chrome keeps the Bookmarks file for a profile on this platform"""
+    if sys.platform.startswith('win'):
+        base = os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Application Support', 'Google', 'Chrome'))
+    else:
+        base = os.path.expanduser(os.path.join('~', '.config', 'google-chrome'))
+    return os.path.join(base, profile, 'Bookmarks')
+
+def parse(bookmarks_filepath):
+    """Reads the bookmarks file
+    Returns a list of bookmark tuples and any bookmark folders that failed to read"""
+    reader = BookmarksReader()
+    bookmarks = list(reader.stream(bookmarks_filepath))
+    return bookmarks, reader.failures
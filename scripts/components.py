@@ -2,14 +2,20 @@ import curses
 import curses.ascii
 import logging
 from math import floor
-from datetime import datetime
 import re
+from collections import OrderedDict
+from contextlib import contextmanager
 from scripts.colours import Colours
 from scripts.math_utils import clamp
+from scripts.fuzzy_utils import FuzzyFilter
+from scripts.event_utils import wakeup
 
 # A regex pattern for extracting the domain from a url
 url_pattern = re.compile(r'(?:\w+)?(?:\://)?(?:w{3}\.)?([\w\d\._-]+)/?.*$')
 
+# How many items' wrapped lines a list menu remembers, plenty for a few screens of scrolling back and forth
+LAYOUT_CACHE_SIZE = 1000
+
 
 class Menu():
     def __init__(self, stdscr, items, functions, menu_title='Menu', position="top"):
@@ -21,13 +27,9 @@ class Menu():
         self.selected = 0
 
         # Use items to determine the width and height of the menu
-
-        self.width = max([len(item) for item in self.items + [self.menu_title if self.menu_title else ""]]) + 4
-        self.height = len(self.items) + 4
         self.h_padding = 4
         self.v_padding = 1
-        # Add on the padding
-        self.width += self.h_padding
+        self.measure()
 
         self.position = position
 
@@ -44,14 +46,26 @@ class Menu():
         self.menu_title_height = 2
         self.offset = 0
 
-    def update(self):
-        """Get keyboard input to navigate the menu,"""
+        # Set when there's something new to draw that didn't come from a key press
+        self.dirty = False
+
+    def measure(self):
+        """Work out the width and height of the menu from the items"""
+        self.width = max([len(item) for item in self.items + [self.menu_title if self.menu_title else ""]]) + 4
+        self.height = len(self.items) + 4
+        # Add on the padding
+        self.width += self.h_padding
+
+    def update(self, key=None):
+        """Get keyboard input to navigate the menu,
+        States that want the keyboard for something else can read the key themselves and pass it in"""
         # Get terminal size
         t_height, t_width = self.stdscr.getmaxyx()
 
         # Clear inputs
-        self.stdscr.nodelay(True)
-        key = self.stdscr.getch()
+        if key is None:
+            self.stdscr.nodelay(True)
+            key = self.stdscr.getch()
         vinput = 0
         if key == curses.KEY_UP:
             vinput -= 1
@@ -169,20 +183,196 @@ class Menu():
         # Draw bottom border
         self.stdscr.addstr(y + len(self.items) + self.v_padding * 2 + 1, x, "+" + "-" * (self.width - 2) + "+", col)
 
+    def refresh(self):
+        """Box menus are drawn straight onto stdscr so there's nothing to do"""
+        pass
+
 class MenuList(Menu):
-    """This is the same as menu with different rendering logic"""
-    def __init__(self, stdscr, items, functions, menu_title='Menu'):
+    """This is the same as menu with different rendering logic
+    The items are drawn in their own window which remembers what's on each row,
+    so only rows that change get redrawn and sent to the terminal
+    Typing filters the list down to the items with those letters in them in order"""
+    def __init__(self, stdscr, items, functions, menu_title='Menu', filterable=True):
         super().__init__(stdscr, items, functions, menu_title)
 
         self.scroll_behaviour = 'scroll'
+        self.window = None
+        # (x, text, colour) for each row currently in the window
+        self.rows = []
+        # Wrapped lines and their x offsets for each item, only good for the width they were worked out for
+        # Least recently used first, so scrolling through a huge list doesn't keep every item it's shown
+        self.layouts = OrderedDict()
+        self.layout_width = None
+
+        # States that want the typing for themselves can turn the filter off
+        self.filterable = filterable
+        self.query = ""
+        self.fuzzy = None
+        # Where the selection and scroll are in the list of matches
+        self.filter_position = 0
+        self.filter_offset = 0
+        # The item that was selected before the items were replaced, the selection moves to it once it's matched again
+        self.filter_selected_item = None
+
+    def measure(self):
+        """List menus fill the terminal so there's nothing to measure
+        This also means we never have to look at every item, which matters for PagedItems"""
+        pass
+
+    def can_filter(self):
+        """Paged items aren't filtered, that would mean loading every row, search is for that"""
+        return self.filterable and not isinstance(self.items, PagedItems)
+
+    def set_query(self, query):
+        """Change the filter and go back to the top of the matches"""
+        self.query = query
+        if self.fuzzy is None or self.fuzzy.texts is not self.items:
+            self.fuzzy = FuzzyFilter(self.items)
+        self.fuzzy.set_query(query)
+        self.filter_position = 0
+        self.filter_offset = 0
+        self.filter_selected_item = None
+
+    def refilter(self):
+        """A state can give us new items at any time, e.g. when more files are found
+        Filter them with the same query, keeping the selection on the same item if it's still there"""
+        matches = self.fuzzy.matches()
+        if matches:
+            self.filter_selected_item = self.fuzzy.texts[matches[clamp(self.filter_position, 0, len(matches) - 1)]]
+        self.fuzzy = FuzzyFilter(self.items)
+        self.fuzzy.set_query(self.query)
+
+    def find_selected_item(self, matches):
+        """Move the selection back onto the item that was selected before the items were replaced
+        Until it turns up the selection stays at the same position"""
+        for position, i in enumerate(matches):
+            if self.items[i] == self.filter_selected_item:
+                self.filter_position = position
+                self.filter_selected_item = None
+                return
+        if self.fuzzy.done():
+            self.filter_selected_item = None
+
+    @contextmanager
+    def filtered(self):
+        """Swap in just the matching items so the normal menu code works on them
+        Outside of this items, functions and selected are always for the whole list"""
+        if self.fuzzy.texts is not self.items:
+            self.refilter()
+        matches = self.fuzzy.matches()
+        if self.filter_selected_item is not None:
+            self.find_selected_item(matches)
+        items, functions, selected, offset = self.items, self.functions, self.selected, self.offset
+        self.items = FilteredItems(items, matches)
+        self.functions = FilteredItems(functions, matches)
+        self.selected = clamp(self.filter_position, 0, max(len(matches) - 1, 0))
+        self.offset = self.filter_offset
+        try:
+            yield matches
+        finally:
+            self.filter_position, self.filter_offset = self.selected, self.offset
+            self.items, self.functions, self.offset = items, functions, offset
+            # Leave the selection on the last match we were on for when the filter is cleared
+            self.selected = matches[self.selected] if matches else selected
+
+    def update(self, key=None):
+        """Typing goes into the filter, everything else is handled by Menu on the items that match"""
+        if key is None:
+            self.stdscr.nodelay(True)
+            key = self.stdscr.getch()
+
+        if self.can_filter():
+            if 32 <= key < 127:
+                self.set_query(self.query + chr(key))
+                key = -1
+            elif key in (curses.KEY_BACKSPACE, 127, 8) and self.query:
+                self.set_query(self.query[:-1])
+                key = -1
+            elif key == curses.ascii.ESC and self.query:
+                # Escape clears the filter before it goes back
+                self.set_query("")
+                key = -1
+
+        if not self.query:
+            return super().update(key)
+
+        if self.fuzzy.texts is not self.items:
+            self.refilter()
+        # Matching a big list is done a bit at a time, wake the main loop up to carry on if it's not finished
+        if not self.fuzzy.done():
+            if not self.fuzzy.work():
+                wakeup()
+            self.dirty = True
+
+        with self.filtered() as matches:
+            if not matches:
+                return None
+            return super().update(key)
+
+    def get_window(self, top, height, width):
+        """Returns the window for the items, making a new one if the terminal or the space above the list has changed"""
+        if self.window is None or self.window.getbegyx()[0] != top or self.window.getmaxyx() != (height, width):
+            self.window = curses.newwin(height, width, top, 0)
+            # Let curses scroll the terminal instead of rewriting every row
+            self.window.idlok(True)
+            self.rows = []
+        return self.window
+
+    def wrap_item(self, item, width):
+        """Split an item into lines that fit the terminal"""
+        if len(item) < width:
+            return [item]
+        # Split string and add one word at a time until we overflow the terminal
+        words = item.split(" ")
+        lines = [""]
+        lines_index = 0
+        for word in words:
+            if len(lines[lines_index]) + len(word) + 1 < width:
+                lines[lines_index] += word + " "
+            else:
+                # Cut the last space
+                lines[lines_index] = lines[lines_index][:-1]
+                lines_index += 1
+                lines.append(word + " ")
+        # A single word can still be too long
+        return [line[:width - 1] for line in lines]
+
+    def get_lines(self, item, width):
+        """Returns the (x, line) pairs for an item, wrapping it the first time it's seen"""
+        # The width only changes when the terminal is resized
+        if width != self.layout_width:
+            self.layouts.clear()
+            self.layout_width = width
+        lines = self.layouts.get(item)
+        if lines is None:
+            # Centre each line
+            lines = tuple((floor((width - len(line)) * 0.5), line) for line in self.wrap_item(item, width))
+            self.layouts[item] = lines
+            if len(self.layouts) > LAYOUT_CACHE_SIZE:
+                self.layouts.popitem(last=False)
+        else:
+            self.layouts.move_to_end(item)
+        return lines
+
+    def layout(self, width, height):
+        """Work out what goes on each row from the offset down
+        Returns the rows and the index of the last item that fit completely"""
+        rows = []
+        last = self.offset - 1
+        for index, item in enumerate(self.items[self.offset:self.offset + height], self.offset):
+            col = self.colours.get_colour('black_on_white') if index == self.selected else self.colours.get_colour('white_on_black')
+            for x, line in self.get_lines(item, width):
+                if len(rows) == height:
+                    return rows, last
+                rows.append((x, line, col))
+            last = index
+        return rows, last
 
     def render(self):
         """Draw the list of menu items"""
         # Get terminal size
         t_height, t_width = self.stdscr.getmaxyx()
 
-        dy = 0
-
         # First draw menu title
         if self.menu_title is not None:
             # Get the y pos
@@ -194,100 +384,169 @@ class MenuList(Menu):
             self.stdscr.addstr("\n")
             # Draw a line under the title
             self.stdscr.addstr("." * t_width, col)
-            dy = self.stdscr.getyx()[0] - y
 
             # Update menu title height
-            self.menu_title_height = dy
+            self.menu_title_height = self.stdscr.getyx()[0] - y
+
+        if self.query:
+            self.stdscr.addstr(f"Filter: {self.query}_\n", self.colours.get_colour('green_on_black') | curses.A_BOLD)
+            with self.filtered() as matches:
+                if not matches and self.fuzzy.done():
+                    self.stdscr.addstr("No matches\n", self.colours.get_colour('red_on_black'))
+                self.render_items()
+        else:
+            self.render_items()
+
+    def render_items(self):
+        """Draw the items under whatever's been drawn already"""
+        t_height, t_width = self.stdscr.getmaxyx()
+
+        # The items go in the rest of the terminal
+        top = self.stdscr.getyx()[0]
+        height = t_height - top
+        if height <= 0:
+            return
 
         # Call the scroll function to adjust the scroll if needed
         self.offset, self.selected = self.scroll(self.offset, self.selected, 0, len(self.items) - 1)
-
-        # We slice items based on the offset
-        items_to_render = self.items[self.offset:self.offset + t_height - dy]
-        # Draw the items - this will except if it goes out of bounds
-        for index, item in enumerate(items_to_render):
-            try:
-                col = self.colours.get_colour('white_on_black')
-                if index + self.offset == self.selected:
-                    col = self.colours.get_colour('black_on_white')
-
-                # Centre the item
-                if len(item) < t_width:
-                    xoffset = floor((t_width - len(item)) * 0.5)
-                    self.stdscr.addstr(" " * xoffset)
-                    self.stdscr.addstr(item, col)
-                else:
-                    try:
-                        # We need to do string slicing to get the item to fit
-                        # Split string and add one word at a time until we overflow the terminal
-                        words = item.split(" ")
-                        lines = [""]
-                        lines_index = 0
-                        for word in words:
-                            if len(lines[lines_index]) + len(word) + 1 < t_width:
-                                lines[lines_index] += word + " "
-                            else:
-                                # Cut the last space
-                                lines[lines_index] = lines[lines_index][:-1]
-                                lines_index += 1
-                                lines.append(word + " ")
-
-                        # Now we can draw the lines centred
-                        for i, line in enumerate(lines):
-                            xoffset = floor((t_width - len(line)) * 0.5)
-                            self.stdscr.addstr(" " * xoffset)
-                            self.stdscr.addstr(line, col)
-                            if i < len(lines) - 1:
-                                self.stdscr.addstr("\n")
-                    except Exception as e:
-                        logging.warning(f"Failed to draw item: {item}")
-                        logging.warning(e)
-                        break
-
-                try:
-                    self.stdscr.addstr("\n")
-                except:
-                    break
-            except Exception as e:
-                # In this case we've gone out of bounds so ensure selection is within bounds
-                # I don't think this ever happens
-                y, _ = self.stdscr.getyx()
-                if y > t_height:
-                    # This will adjust the scroll if needed
-                    if index - self.offset - dy <= self.selected:
-                        logging.debug(f"Adjusting scroll up by {y - t_height - dy}")
-                        self.offset -= (y - t_height - dy)
-                        self.stdscr.clear()
-                        self.stdscr.refresh()
-                        self.render()
-                    break
+        rows, last = self.layout(t_width, height)
+        # Long items wrap onto more than one row so the selection can still end up off the bottom
+        while self.selected > last and self.offset < self.selected:
+            self.offset += 1
+            rows, last = self.layout(t_width, height)
+
+        # Only touch the rows that are different to last time
+        window = self.get_window(top, height, t_width)
+        rows += [None] * (height - len(rows))
+        for y, row in enumerate(rows):
+            if y < len(self.rows) and self.rows[y] == row:
+                continue
+            window.move(y, 0)
+            window.clrtoeol()
+            if row is not None:
+                x, text, col = row
+                window.addstr(y, x, text, col)
+        self.rows = rows
+
+    def refresh(self):
+        """Copy the items onto the screen, this has to happen after stdscr has been refreshed"""
+        if self.window is not None:
+            # stdscr was erased over the top of us so all of our rows need copying again
+            self.window.touchwin()
+            self.window.noutrefresh()
+
+class FilteredItems():
+    """Read only view of the items at the given indices, for showing the matches of a filter"""
+    def __init__(self, items, indices):
+        self.items = items
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.items[i] for i in self.indices[index]]
+        return self.items[self.indices[index]]
+
+    def __contains__(self, item):
+        return any(self.items[i] == item for i in self.indices)
+
+    def index(self, item):
+        for position, i in enumerate(self.indices):
+            if self.items[i] == item:
+                return position
+        raise ValueError(f"{item} is not in the filtered items")
+
+class PagedItems():
+    """Read only list for menus that makes its items on demand from a pager (or any sequence)
+    Fixed items can be put before and after the paged ones, e.g. "Randomise" and "Back"
+    Indexing and slicing only touch the rows that are asked for"""
+    def __init__(self, pager, transform, head=None, tail=None):
+        self.pager = pager
+        self.transform = transform
+        self.head = head if head is not None else []
+        self.tail = tail if tail is not None else []
+
+    def __len__(self):
+        return len(self.head) + len(self.pager) + len(self.tail)
+
+    def __getitem__(self, index):
+        head_length = len(self.head)
+        pager_length = len(self.pager)
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            # Take whatever part of the slice falls in each of head, pager and tail
+            items = self.head[start:max(start, min(stop, head_length))]
+            pager_start = max(start - head_length, 0)
+            pager_stop = min(stop - head_length, pager_length)
+            if pager_start < pager_stop:
+                items += [self.transform(item) for item in self.pager[pager_start:pager_stop]]
+            tail_start = max(start - head_length - pager_length, 0)
+            tail_stop = stop - head_length - pager_length
+            if tail_start < tail_stop:
+                items += self.tail[tail_start:tail_stop]
+            return items
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("menu item index out of range")
+        if index < head_length:
+            return self.head[index]
+        if index < head_length + pager_length:
+            return self.transform(self.pager[index - head_length])
+        return self.tail[index - head_length - pager_length]
+
+    def __contains__(self, item):
+        # Only the fixed items are searched, looking through the pager would load every row
+        return item in self.head or item in self.tail
+
+    def index(self, item):
+        """Returns the index of a fixed item"""
+        if item in self.head:
+            return self.head.index(item)
+        if item in self.tail:
+            return len(self.head) + len(self.pager) + self.tail.index(item)
+        raise ValueError(f"{item} is not a fixed menu item")
 
 class Bookmark():
+    """One bookmark row, lists can have 100k of these so only the columns are stored
+    The other attributes are worked out from them when they're asked for"""
+    __slots__ = ('id', 'title', 'url', 'add_date', 'folder')
+
     def __init__(self, record):
         """Initialise the bookmark"""
-        self.id = record[0]
-        self.title = record[1]
-        self.url = record[2]
-        self.add_date = record[3]
-        self.folder = record[4]
+        self.id, self.title, self.url, self.add_date, self.folder = record[:5]
+
+    # add_date always comes out of SQLite as "YYYY-MM-DD HH:MM:SS" so the parts can be sliced out
+    @property
+    def add_date_formatted(self):
+        return f"{self.add_date[8:10]}/{self.add_date[5:7]}/{self.add_date[:4]}"
 
-        # Also some alternative formatting for the date
-        self.add_date_formatted = datetime.strptime(self.add_date, "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y")
+    @property
+    def year(self):
+        return self.add_date[:4]
 
-        # Format the URL to get the domain name (including subdomains)
+    @property
+    def month(self):
+        return self.add_date[5:7]
+
+    @property
+    def domain(self):
+        """The domain name including subdomains"""
         try:
-            self.domain = ".".join(url_pattern.match(self.url).group(1).split('.')[:-1])
+            domain = ".".join(url_pattern.match(self.url).group(1).split('.')[:-1])
             # .co.uk domains will include the .co
-            if self.domain.endswith(".co"):
-                self.domain = self.domain[:-3]
+            if domain.endswith(".co"):
+                domain = domain[:-3]
+            return domain
         except:
             logging.warning(f"Failed to extract domain from url: {self.url}")
-            self.domain = "Unknown"
-
-        # We should add a year and month attribute for filtering
-        self.year = self.add_date_formatted.split("/")[2]
-        self.month = self.add_date_formatted.split("/")[1]
-
+            return "Unknown"
 
     def get_attributes(self):
         """Return a list of attributes"""
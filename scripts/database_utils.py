@@ -1,11 +1,309 @@
 import sqlite3
+import re
 import os
+import json
+import time
+import atexit
+import hashlib
 import logging
+from array import array
+from datetime import datetime
+from random import randrange
 from scripts.components import Bookmark
+from scripts.math_utils import ShuffleBag
+
+# Connection settings
+# With persistent connections there's one connection per database file for the whole process,
+# opening and closing a Database just borrows it
+PERSISTENT_CONNECTIONS = True
+# Prepared statements kept per connection, sqlite3 caches them by query text
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = [
+    # WAL lets the scraper write while the explorer reads
+    "PRAGMA journal_mode = WAL",
+    # NORMAL is safe with WAL and only syncs on checkpoints
+    "PRAGMA synchronous = NORMAL",
+    # Negative cache size is in KiB so this is about 64MB
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Open persistent connections, keyed by process id and absolute path
+connections = {}
+
+# Called with the database path after bookmarks have been deleted, for anything that keeps its own copy of them
+delete_listeners = []
+
+# Bump this when adding a step to Database.migrate
+SCHEMA_VERSION = 10
+# Databases that have been migrated by this process, keyed like connections
+migrated = set()
+
+BOOKMARKS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookmarks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    url TEXT,
+    add_date TEXT,
+    folder TEXT,
+    CONSTRAINT unique_bookmark UNIQUE (title, url, add_date, folder)
+)
+"""
+
+DESCRIPTIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS descriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content TEXT,
+    relevant_content TEXT,
+    description TEXT,
+    tags TEXT,
+    bookmark_id INTEGER,  -- Foreign key referencing bookmarks table
+    FOREIGN KEY (bookmark_id) REFERENCES bookmarks (id),
+    CONSTRAINT unique_description UNIQUE (bookmark_id)
+)
+"""
+
+# Tags are stored normalised like the BigQuery schema, descriptions.tags is kept for display
+TAGS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS tags (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bookmark_tags (
+        tag_id INTEGER NOT NULL,
+        bookmark_id INTEGER NOT NULL,
+        FOREIGN KEY (tag_id) REFERENCES tags (id),
+        FOREIGN KEY (bookmark_id) REFERENCES bookmarks (id),
+        PRIMARY KEY (tag_id, bookmark_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_bookmark_tags_bookmark ON bookmark_tags (bookmark_id)",
+]
+
+# add_date is stored as 'YYYY-MM-DD HH:MM:SS' which sorts the same as the dates do,
+# so date browsing can use range scans on this index instead of strftime on every row
+DATES_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_add_date ON bookmarks (add_date)",
+]
+
+# Indexes for paging through bookmarks in title order, the rowid is the tie breaker
+PAGING_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_title ON bookmarks (title)",
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_folder_title ON bookmarks (folder, title)",
+]
+# The pager sorts missing titles as '' so they can be compared, the indexes have to match that expression
+PAGING_NULLS_SCHEMA = [
+    "DROP INDEX IF EXISTS idx_bookmarks_title",
+    "DROP INDEX IF EXISTS idx_bookmarks_folder_title",
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_title ON bookmarks (COALESCE(title, ''))",
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_folder_title ON bookmarks (folder, COALESCE(title, ''))",
+]
+
+# Nested folders, each folder has its parent and a materialised path of the folder names from the top
+# folder_closure has a row for every (ancestor, descendant) pair including each folder with itself,
+# so anything about a whole subtree is one indexed join
+FOLDERS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS folders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent_id INTEGER,
+        name TEXT NOT NULL,
+        path TEXT NOT NULL UNIQUE,
+        depth INTEGER NOT NULL,
+        FOREIGN KEY (parent_id) REFERENCES folders (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_folders_parent ON folders (parent_id, name)",
+    """
+    CREATE TABLE IF NOT EXISTS folder_closure (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_folder_closure_descendant ON folder_closure (descendant_id)",
+    "ALTER TABLE bookmarks ADD COLUMN folder_id INTEGER REFERENCES folders (id)",
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_folder_id ON bookmarks (folder_id, title)",
+]
+# Folder names can have just about anything in them so paths are joined with the ASCII unit separator
+FOLDER_SEPARATOR = "\x1f"
+
+# Fingerprints of the exports we've imported so importing the same file again can be skipped
+IMPORTS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS imports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT,
+        fingerprint TEXT NOT NULL,
+        imported_at TEXT NOT NULL
+    )
+    """,
+]
+
+# Full text search over everything we know about a bookmark, the rowid is the bookmark id
+# The triggers keep it up to date as bookmarks are imported and the scraper writes descriptions
+SEARCH_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS bookmarks_fts USING fts5 (
+        title, url, description, tags, content,
+        tokenize = 'porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS bookmarks_fts_insert AFTER INSERT ON bookmarks BEGIN
+        INSERT INTO bookmarks_fts (rowid, title, url) VALUES (new.id, new.title, new.url);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS bookmarks_fts_update AFTER UPDATE OF title, url ON bookmarks BEGIN
+        UPDATE bookmarks_fts SET title = new.title, url = new.url WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS bookmarks_fts_delete AFTER DELETE ON bookmarks BEGIN
+        DELETE FROM bookmarks_fts WHERE rowid = old.id;
+    END
+    """,
+    # INSERT OR REPLACE doesn't fire delete triggers, but the insert one overwrites everything anyway
+    """
+    CREATE TRIGGER IF NOT EXISTS descriptions_fts_insert AFTER INSERT ON descriptions BEGIN
+        UPDATE bookmarks_fts SET description = new.description, tags = new.tags, content = new.content
+        WHERE rowid = new.bookmark_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS descriptions_fts_update AFTER UPDATE ON descriptions BEGIN
+        UPDATE bookmarks_fts SET description = new.description, tags = new.tags, content = new.content
+        WHERE rowid = new.bookmark_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS descriptions_fts_delete AFTER DELETE ON descriptions BEGIN
+        UPDATE bookmarks_fts SET description = NULL, tags = NULL, content = NULL
+        WHERE rowid = old.bookmark_id;
+    END
+    """,
+    """
+    INSERT INTO bookmarks_fts (rowid, title, url, description, tags, content)
+    SELECT bookmarks.id, bookmarks.title, bookmarks.url, descriptions.description, descriptions.tags, descriptions.content
+    FROM bookmarks
+    LEFT JOIN descriptions ON descriptions.bookmark_id = bookmarks.id
+    """,
+]
+# bm25 weights for title, url, description, tags and content
+SEARCH_WEIGHTS = (10.0, 2.0, 5.0, 5.0, 1.0)
+SEARCH_LIMIT = 100
+# Matches in snippets are wrapped in these so they can be highlighted
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+# Document frequencies of every cleaned word across the scraped pages, for picking tags by TF-IDF
+# tag_corpus has the bookmarks that have been counted so re-scraping one doesn't count it twice
+TAG_STATS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS term_stats (
+        term TEXT PRIMARY KEY,
+        document_frequency INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tag_corpus (
+        bookmark_id INTEGER PRIMARY KEY
+    )
+    """,
+]
+
+# How far long running jobs over old rows have got, so they carry on where they stopped
+BACKFILLS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS backfills (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+]
+
+# Syncing matches an export against the bookmarks on url and add_date
+SYNC_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_bookmarks_url_add_date ON bookmarks (url, add_date)",
+]
+# The export being synced is loaded into this, it only lasts as long as the connection
+EXPORT_SCHEMA = [
+    "DROP TABLE IF EXISTS temp.export_bookmarks",
+    """
+    CREATE TEMP TABLE export_bookmarks (
+        position INTEGER PRIMARY KEY,
+        title TEXT,
+        url TEXT,
+        add_date TEXT,
+        folder TEXT,
+        folder_id INTEGER,
+        UNIQUE (url, add_date)
+    )
+    """,
+]
+ADD_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Rows fetched either side of the requested ones when paging through bookmarks
+PAGE_PREFETCH = 50
+
+# Bookmark ids for random sampling, keyed by database path and restrictions
+# Cleared whenever bookmarks are added or removed
+samplers = {}
+
+# Write behind settings for scraped descriptions
+# The buffer is flushed once it has this many rows or this many seconds have passed
+FLUSH_ROWS = 200
+FLUSH_SECONDS = 5
+
+def connect(db_path):
+    """Open a new connection with our pragmas applied"""
+    db = sqlite3.connect(db_path, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+def get_connection(db_path):
+    """Returns the persistent connection for a database, opening it if needed"""
+    # Include the pid so a forked process doesn't reuse its parent's connection
+    key = (os.getpid(), os.path.abspath(db_path))
+    if key not in connections:
+        connections[key] = connect(db_path)
+        logging.info(f"Opened persistent connection to {db_path}")
+    return connections[key]
+
+def close_connection(db_path):
+    """Close the persistent connection for a database if there is one"""
+    key = (os.getpid(), os.path.abspath(db_path))
+    # Whatever replaces this database will need migrating again
+    migrated.discard(key)
+    db = connections.pop(key, None)
+    if db:
+        db.close()
+
+@atexit.register
+def close_connections():
+    """Close every persistent connection"""
+    for key in list(connections.keys()):
+        connections.pop(key).close()
+
+def delete_database(db_path='bookmarks.db'):
+    """Delete a database along with its WAL files, descriptions journal and similarity indexes"""
+    close_connection(db_path)
+    clear_samplers(db_path)
+    for path in [db_path, db_path + '-wal', db_path + '-shm', get_journal_path(db_path), get_similarity_path(db_path), get_lsh_path(db_path)]:
+        if os.path.exists(path):
+            os.remove(path)
 
 class Database():
-    def __init__(self, db_path='bookmarks.db'):
+    def __init__(self, db_path='bookmarks.db', persistent=PERSISTENT_CONNECTIONS):
         self.db_path = db_path
+        self.persistent = persistent
         self.db = None
         self.cursor = None
 
@@ -15,13 +313,93 @@ class Database():
 
     def open_database(self):
         """Loads the database"""
-        self.db = sqlite3.connect(self.db_path)
+        if self.persistent:
+            self.db = get_connection(self.db_path)
+        else:
+            self.db = connect(self.db_path)
         self.cursor = self.db.cursor()
 
+        # Bring older databases up to date the first time we see them
+        key = (os.getpid(), os.path.abspath(self.db_path))
+        if key not in migrated:
+            migrated.add(key)
+            self.migrate()
+
+    def migrate(self):
+        """Update the schema to SCHEMA_VERSION, tracked with PRAGMA user_version"""
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        logging.info(f"Migrating database from version {version} to {SCHEMA_VERSION}")
+        # The migrations build on the original tables
+        self.cursor.execute(BOOKMARKS_SCHEMA)
+        self.cursor.execute(DESCRIPTIONS_SCHEMA)
+
+        if version < 1:
+            # Move comma separated tags into the tags tables
+            for query in TAGS_SCHEMA:
+                self.cursor.execute(query)
+            self.cursor.execute("SELECT bookmark_id, tags FROM descriptions WHERE tags IS NOT NULL")
+            self.set_tags(self.cursor.fetchall())
+
+        if version < 2:
+            for query in DATES_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 3:
+            for query in PAGING_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 4:
+            for query in FOLDERS_SCHEMA:
+                self.cursor.execute(query)
+            # Older databases only have flat folder names, these become top level folders
+            self.cursor.execute("SELECT DISTINCT folder FROM bookmarks WHERE folder IS NOT NULL")
+            for (folder,) in self.cursor.fetchall():
+                folder_id = self.get_folder_id((folder,))
+                self.db.execute("UPDATE bookmarks SET folder_id = ? WHERE folder = ?", (folder_id, folder))
+
+        if version < 5:
+            for query in IMPORTS_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 6:
+            # Some SQLite builds don't have FTS5, everything but search still works without it
+            try:
+                for query in SEARCH_SCHEMA:
+                    self.cursor.execute(query)
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Full text search isn't available: {e}")
+
+        if version < 7:
+            # The pages we've already got are counted in the background, see tag_utils.start_corpus_count
+            for query in TAG_STATS_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 8:
+            for query in SYNC_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 9:
+            for query in BACKFILLS_SCHEMA:
+                self.cursor.execute(query)
+
+        if version < 10:
+            for query in PAGING_NULLS_SCHEMA:
+                self.cursor.execute(query)
+
+        # PRAGMA doesn't take parameters
+        self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.commit()
+
     def close_database(self):
-        """Closes the database"""
+        """Closes the database
+        Persistent connections stay open, we just let go of them"""
         if self.db:
-            self.db.close()
+            if not self.persistent:
+                self.db.close()
             self.cursor = None
             self.db = None
 
@@ -50,17 +428,7 @@ class Database():
         # Create the table if it doesn't exist
         # Schema: id (primary key), title, url, add_date, folder
         #--------------------------------------------------------------------------------#
-        query = """
-        CREATE TABLE IF NOT EXISTS bookmarks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            url TEXT,
-            add_date TEXT,
-            folder TEXT,
-            CONSTRAINT unique_bookmark UNIQUE (title, url, add_date, folder)
-        )
-        """
-        self.cursor.execute(query)
+        self.cursor.execute(BOOKMARKS_SCHEMA)
 
         # Commit changes and close database
         self.db.commit()
@@ -80,26 +448,15 @@ class Database():
         # Description is the description of the page
         # Tags are the tags for the page
         #--------------------------------------------------------------------------------#
-        query = """
-        CREATE TABLE IF NOT EXISTS descriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            content TEXT,
-            relevant_content TEXT,
-            description TEXT,
-            tags TEXT,
-            bookmark_id INTEGER,  -- Foreign key referencing bookmarks table
-            FOREIGN KEY (bookmark_id) REFERENCES bookmarks (id),
-            CONSTRAINT unique_description UNIQUE (bookmark_id)
-        )
-        """
-        self.cursor.execute(query)
+        self.cursor.execute(DESCRIPTIONS_SCHEMA)
 
         # Commit changes and close database
         self.db.commit()
         self.close_database()
 
     def export_bookmarks(self, bookmarks):
-        """Creates the primary table containing bookmarks"""
+        """Creates the primary table containing bookmarks
+        Bookmarks are (title, url, add_date, folder) tuples, optionally with the folder path on the end"""
         # Setup tables
         self.create_tables()
 
@@ -107,18 +464,208 @@ class Database():
         if not self.database_is_connected():
             self.open_database()
 
+        self.insert_bookmarks(bookmarks)
+
+        # Commit changes and close database
+        self.db.commit()
+        self.close_database()
+
+        # The cached ids for random bookmarks are out of date now
+        clear_samplers(self.db_path)
+
+    def insert_bookmarks(self, bookmarks):
+        """Insert bookmark tuples, creating their folders as we go, doesn't commit"""
         # Insert UNIQUE bookmarks using window title, url, and add_date
         # The ids are autoincremented so won't necessarily be unique
         query = """
-        INSERT OR IGNORE INTO bookmarks (title, url, add_date, folder)
-        VALUES (?, ?, ?, ?)
+        INSERT OR IGNORE INTO bookmarks (title, url, add_date, folder, folder_id)
+        VALUES (?, ?, ?, ?, ?)
+        """
+        self.cursor.executemany(query, self.bookmark_rows(bookmarks))
+
+    def bookmark_rows(self, bookmarks):
+        """Yields (title, url, add_date, folder, folder_id) rows for bookmark tuples, creating their folders as we go"""
+        folder_ids = {}
+        for bookmark in bookmarks:
+            title, url, add_date, folder = bookmark[:4]
+            folder_path = get_folder_path(bookmark)
+            if folder_path not in folder_ids:
+                folder_ids[folder_path] = self.get_folder_id(folder_path)
+            yield (title, url, format_add_date(add_date), folder, folder_ids[folder_path])
+
+    def sync_bookmarks(self, bookmarks, source=None, fingerprint=None):
+        """Make the bookmarks table match an export, only touching what's changed
+        Bookmarks are matched on url and add_date, new ones are inserted, ones that changed title or folder are moved,
+        and ones that aren't in the export any more are deleted along with their descriptions and tags
+        If the fingerprint matches the last import nothing is read at all
+        Returns a dictionary of how many bookmarks were inserted, moved and deleted"""
+        self.create_tables()
+
+        # Open database if not already open
+        if not self.database_is_connected():
+            self.open_database()
+
+        changes = {'inserted': 0, 'moved': 0, 'deleted': 0}
+        if fingerprint is not None and fingerprint == self.get_last_fingerprint():
+            logging.info(f"Bookmarks export is the same as the last import: {source}")
+            self.close_database()
+            return changes
+
+        # Load the export into a temporary table so the diff can be done with joins instead of reading every bookmark
+        # The unique constraint keeps the first of any repeats and is the index the joins use
+        for query in EXPORT_SCHEMA:
+            self.cursor.execute(query)
+        query = """
+        INSERT OR IGNORE INTO export_bookmarks (title, url, add_date, folder, folder_id)
+        VALUES (?, ?, ?, ?, ?)
         """
-        self.cursor.executemany(query, bookmarks)
+        self.cursor.executemany(query, self.bookmark_rows(bookmarks))
+
+        # Anything not in the export goes, as do any duplicates
+        # There can be more than one row per url and add_date if a bookmark was moved and imported again before we had syncing
+        query = """
+        SELECT id FROM bookmarks
+        WHERE NOT EXISTS (
+            SELECT 1 FROM export_bookmarks
+            WHERE export_bookmarks.url IS bookmarks.url AND export_bookmarks.add_date IS bookmarks.add_date
+        )
+        OR id != (
+            SELECT MIN(id) FROM bookmarks AS original
+            WHERE original.url IS bookmarks.url AND original.add_date IS bookmarks.add_date
+        )
+        """
+        self.cursor.execute(query)
+        deletes = [record[0] for record in self.cursor.fetchall()]
+
+        # Deletes first so moves can't clash with a duplicate on the unique constraint
+        self.delete_bookmarks(deletes)
+
+        # Ones that changed title or folder are moved
+        query = """
+        UPDATE bookmarks SET (title, folder, folder_id) = (
+            SELECT title, folder, folder_id FROM export_bookmarks
+            WHERE export_bookmarks.url IS bookmarks.url AND export_bookmarks.add_date IS bookmarks.add_date
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM export_bookmarks
+            WHERE export_bookmarks.url IS bookmarks.url AND export_bookmarks.add_date IS bookmarks.add_date
+            AND (export_bookmarks.title IS NOT bookmarks.title OR export_bookmarks.folder IS NOT bookmarks.folder
+                 OR export_bookmarks.folder_id IS NOT bookmarks.folder_id)
+        )
+        """
+        self.cursor.execute(query)
+        moves = self.cursor.rowcount
+
+        # And the rest are new, in the order they're in the export
+        query = """
+        INSERT OR IGNORE INTO bookmarks (title, url, add_date, folder, folder_id)
+        SELECT title, url, add_date, folder, folder_id FROM export_bookmarks
+        WHERE NOT EXISTS (
+            SELECT 1 FROM bookmarks
+            WHERE bookmarks.url IS export_bookmarks.url AND bookmarks.add_date IS export_bookmarks.add_date
+        )
+        ORDER BY position
+        """
+        self.cursor.execute(query)
+        inserts = self.cursor.rowcount
+        self.cursor.execute("DROP TABLE temp.export_bookmarks")
+
+        # Folders can be left with nothing in them now
+        if moves or deletes:
+            self.prune_folders()
+
+        if fingerprint is not None:
+            query = """
+            INSERT INTO imports (source, fingerprint, imported_at)
+            VALUES (?, ?, ?)
+            """
+            self.cursor.execute(query, (source, fingerprint, str(datetime.now().replace(microsecond=0))))
 
         # Commit changes and close database
         self.db.commit()
         self.close_database()
 
+        # Moves change which bookmarks are in a folder
+        if inserts or deletes or moves:
+            clear_samplers(self.db_path)
+        if deletes:
+            for listener in delete_listeners:
+                listener(self.db_path)
+
+        changes = {'inserted': inserts, 'moved': moves, 'deleted': len(deletes)}
+        logging.info(f"Synced bookmarks from {source}: {changes}")
+        return changes
+
+    def delete_bookmarks(self, bookmark_ids):
+        """Delete bookmarks along with their descriptions and tags, doesn't commit"""
+        bookmark_ids = [(bookmark_id,) for bookmark_id in bookmark_ids]
+        self.cursor.executemany("DELETE FROM bookmark_tags WHERE bookmark_id = ?", bookmark_ids)
+        self.cursor.executemany("DELETE FROM descriptions WHERE bookmark_id = ?", bookmark_ids)
+        self.cursor.executemany("DELETE FROM bookmarks WHERE id = ?", bookmark_ids)
+
+    def prune_folders(self):
+        """Delete folders that don't have any bookmarks in them or their subfolders, doesn't commit"""
+        query = """
+        DELETE FROM folders
+        WHERE NOT EXISTS (
+            SELECT 1 FROM folder_closure
+            JOIN bookmarks ON bookmarks.folder_id = folder_closure.descendant_id
+            WHERE folder_closure.ancestor_id = folders.id
+        )
+        """
+        self.cursor.execute(query)
+        if self.cursor.rowcount:
+            logging.info(f"Deleted {self.cursor.rowcount} empty folders")
+            query = """
+            DELETE FROM folder_closure
+            WHERE ancestor_id NOT IN (SELECT id FROM folders) OR descendant_id NOT IN (SELECT id FROM folders)
+            """
+            self.cursor.execute(query)
+
+    def get_last_fingerprint(self):
+        """Returns the fingerprint of the most recent import, or None"""
+        self.cursor.execute("SELECT fingerprint FROM imports ORDER BY id DESC LIMIT 1")
+        record = self.cursor.fetchone()
+        return record[0] if record else None
+
+    def get_backfill_progress(self, name):
+        """Returns the last id a backfill got to, 0 if it hasn't started"""
+        self.cursor.execute("SELECT last_id FROM backfills WHERE name = ?", (name,))
+        record = self.cursor.fetchone()
+        return record[0] if record else 0
+
+    def set_backfill_progress(self, name, last_id):
+        """Record how far a backfill has got, doesn't commit so it goes in with the backfill's own writes"""
+        self.cursor.execute("INSERT OR REPLACE INTO backfills (name, last_id) VALUES (?, ?)", (name, last_id))
+
+    def get_folder_id(self, folder_path):
+        """Returns the id for a folder path (a tuple of folder names from the top), creating any missing folders
+        Doesn't commit, and uses its own cursors so it's safe to call in the middle of an executemany"""
+        if not folder_path or folder_path == (None,):
+            return None
+
+        path = FOLDER_SEPARATOR.join(folder_path)
+        record = self.db.execute("SELECT id FROM folders WHERE path = ?", (path,)).fetchone()
+        if record:
+            return record[0]
+
+        parent_id = self.get_folder_id(folder_path[:-1])
+        query = """
+        INSERT INTO folders (parent_id, name, path, depth)
+        VALUES (?, ?, ?, ?)
+        """
+        folder_id = self.db.execute(query, (parent_id, folder_path[-1], path, len(folder_path) - 1)).lastrowid
+
+        # The folder is its own ancestor, and it's one level further from everything above its parent
+        query = """
+        INSERT INTO folder_closure (ancestor_id, descendant_id, depth)
+        SELECT ?, ?, 0
+        UNION ALL
+        SELECT ancestor_id, ?, depth + 1 FROM folder_closure WHERE descendant_id = ?
+        """
+        self.db.execute(query, (folder_id, folder_id, folder_id, parent_id))
+        return folder_id
+
     def insert_descriptions(self, descriptions):
         """Exports the descriptions to the database
         Input is list of tuples of the form (bookmark_id, content, relevant_content, description, tags)"""
@@ -127,16 +674,43 @@ class Database():
             self.open_database()
 
         # Insert UNIQUE descriptions using title and description
+        # A sync can delete bookmarks while their pages are still waiting to be written, those are skipped
         query = """
         INSERT OR REPLACE INTO descriptions (bookmark_id, content, relevant_content, description, tags)
-        VALUES (?, ?, ?, ?, ?)
+        SELECT id, ?, ?, ?, ? FROM bookmarks WHERE id = ?
         """
-        self.cursor.executemany(query, descriptions)
+        # Anything the tagger counted for these rows is in the same transaction, so it's all written or none of it is
+        try:
+            self.cursor.executemany(query, [tuple(description[1:5]) + (description[0],) for description in descriptions])
+            self.set_tags([(description[0], description[4]) for description in descriptions])
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
 
         # Commit changes and close database
         self.db.commit()
         self.close_database()
 
+        # Tag restrictions pick different bookmarks now, the rest can keep going through their bags
+        clear_samplers(self.db_path, table='bookmark_tags')
+
+    def set_tags(self, bookmark_tags):
+        """Replace the tags for bookmarks, doesn't commit
+        Input is a list of tuples of the form (bookmark_id, tags) where tags is comma separated"""
+        bookmark_tags = [(bookmark_id, split_tags(tags)) for bookmark_id, tags in bookmark_tags]
+
+        self.cursor.executemany("DELETE FROM bookmark_tags WHERE bookmark_id = ?", [(bookmark_id,) for bookmark_id, _ in bookmark_tags])
+
+        names = {tag for _, tags in bookmark_tags for tag in tags}
+        self.cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(name,) for name in names])
+
+        # Bookmarks that have been deleted don't get tagged
+        query = """
+        INSERT OR IGNORE INTO bookmark_tags (tag_id, bookmark_id)
+        SELECT id, ? FROM tags WHERE name = ? AND EXISTS (SELECT 1 FROM bookmarks WHERE bookmarks.id = ?)
+        """
+        self.cursor.executemany(query, [(bookmark_id, tag, bookmark_id) for bookmark_id, tags in bookmark_tags for tag in tags])
+
     def query(self, query, params=None):
         """Generic method for arbitrary queries"""
         # Open database if not already open
@@ -172,32 +746,43 @@ class Database():
         self.cursor.execute(query)
         return self.cursor.fetchall()
 
-    def get_random_bookmark(self, restrictions=None):
-        """Return a random bookmark"""
-        query = """
-        SELECT * FROM bookmarks
-        JOIN descriptions ON bookmarks.id = descriptions.bookmark_id
-        """
-
+    def get_random_bookmark(self, restrictions=None, no_repeat=True):
+        """Return a random bookmark
+        The ids matching the restrictions are loaded once and cached, after that each pick is a single lookup
+        With no_repeat we won't pick the same bookmark twice until we've been through them all"""
         # Pass in restrictions here, should be a where statement or list of where statements
-        if restrictions is not None:
-            if type(restrictions) is str:
-                query += "WHERE " + restrictions
-            else:
-                query += "WHERE "
-                for restriction in restrictions:
-                    query += restriction + ' AND '
-                # Remove the last AND
-                query = query[:-5]
+        if restrictions is not None and type(restrictions) is not str:
+            restrictions = ' AND '.join(restrictions)
 
+        key = (os.path.abspath(self.db_path), restrictions)
+        if key not in samplers:
+            query = "SELECT bookmarks.id FROM bookmarks"
+            if restrictions is not None:
+                query += " WHERE " + restrictions
+            self.cursor.execute(query)
+            samplers[key] = ShuffleBag(array('q', (record[0] for record in self.cursor.fetchall())))
+
+        sampler = samplers[key]
+        if len(sampler) == 0:
+            logging.warning(f"No bookmarks to pick from with restrictions: {restrictions}")
+            return None
 
-        query += """
-        ORDER BY RANDOM()
-        LIMIT 1
+        if no_repeat:
+            bookmark_id = sampler.draw()
+        else:
+            bookmark_id = sampler.items[randrange(len(sampler))]
+        return self.get_bookmark(bookmark_id)
+
+    def get_bookmark(self, bookmark_id):
+        """Returns a single bookmark by id"""
+        query = """
+        SELECT * FROM bookmarks
+        WHERE id = ?
         """
 
-        self.cursor.execute(query)
-        return Bookmark(self.cursor.fetchone())
+        self.cursor.execute(query, (bookmark_id,))
+        record = self.cursor.fetchone()
+        return Bookmark(record) if record else None
 
     def get_description(self, bookmark_id):
         """Returns the description for a bookmark"""
@@ -207,7 +792,9 @@ class Database():
         """
 
         self.cursor.execute(query, (bookmark_id,))
-        return self.cursor.fetchone()[0]
+        record = self.cursor.fetchone()
+        # Bookmarks that haven't been scraped don't have a row
+        return record[0] if record else None
 
     def get_tags(self, bookmark_id):
         """Returns the tags for a bookmark"""
@@ -217,65 +804,103 @@ class Database():
         """
 
         self.cursor.execute(query, (bookmark_id,))
-        return self.cursor.fetchone()[0]
+        record = self.cursor.fetchone()
+        return record[0] if record else None
 
-    def get_all_tags(self):
-        """Returns all tags"""
-        query = """
-        SELECT DISTINCT tags FROM descriptions
-        WHERE tags IS NOT NULL
-        """
+    def search_bookmarks(self, text, limit=SEARCH_LIMIT):
+        """Full text search, returns a list of (bookmark, snippet) tuples with the best matches first
+        The last word is matched as a prefix so results come up while it's being typed"""
+        match = search_query(text)
+        if match is None:
+            return []
 
-        self.cursor.execute(query)
+        # Open database if not already open
+        if not self.database_is_connected():
+            self.open_database()
 
-        results = self.cursor.fetchall()
+        weights = ", ".join(str(weight) for weight in SEARCH_WEIGHTS)
+        query = f"""
+        SELECT bookmarks.id, bookmarks.title, bookmarks.url, bookmarks.add_date, bookmarks.folder,
+            snippet(bookmarks_fts, -1, ?, ?, '...', 12)
+        FROM bookmarks_fts
+        JOIN bookmarks ON bookmarks.id = bookmarks_fts.rowid
+        WHERE bookmarks_fts MATCH ?
+        ORDER BY bm25(bookmarks_fts, {weights})
+        LIMIT ?
+        """
 
-        # Tags are separated by commas, so split them
-        # No duplicates
-        tags = []
-        for result in results:
-            tags.extend([t for t in result[0].split(',') if t not in tags])
-        return sorted(tags)
+        try:
+            self.cursor.execute(query, (HIGHLIGHT_START, HIGHLIGHT_END, match, limit))
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Search failed: {e}")
+            return []
+        return [(Bookmark(record[:5]), record[5]) for record in self.cursor.fetchall()]
 
-    def get_bookmarks_by_tag(self, tag):
-        """Returns all bookmarks with a tag"""
+    def get_all_tags(self):
+        """Returns all tags that are in use"""
         query = """
-        SELECT * FROM bookmarks
-        JOIN descriptions ON bookmarks.id = descriptions.bookmark_id
-        WHERE tags LIKE ?
-        OR tags LIKE ?
-        OR tags LIKE ?
+        SELECT name FROM tags
+        WHERE EXISTS (
+            SELECT 1 FROM bookmark_tags JOIN bookmarks ON bookmarks.id = bookmark_tags.bookmark_id
+            WHERE bookmark_tags.tag_id = tags.id
+        )
+        ORDER BY name ASC
         """
 
-        self.cursor.execute(query, ('%,'+tag,'%,'+tag+',%',tag+',%'))
-        return [Bookmark(record) for record in self.cursor.fetchall()]
+        self.cursor.execute(query)
+        return [tag[0] for tag in self.cursor.fetchall()]
+
+    def get_bookmarks_by_tag(self, tag):
+        """Returns a pager over all bookmarks with a tag"""
+        where = "bookmarks.id IN (SELECT bookmark_id FROM bookmark_tags JOIN tags ON tags.id = bookmark_tags.tag_id WHERE tags.name = ?)"
+        return BookmarkPager(self, where, (tag,))
 
     def get_bookmarks_by_category(self, category):
-        """Returns all bookmarks in a category"""
+        """Returns a pager over all bookmarks in a category"""
+        return BookmarkPager(self, "folder = ?", (category,))
+
+    def get_child_folders(self, parent_id=None):
+        """Returns the folders inside a folder, or the top level folders if parent_id is None
+        Each folder is a tuple of (id, name, bookmarks in the whole subtree, has subfolders)
+        Subfolders only count if there are bookmarks in them somewhere"""
         query = """
-        SELECT * FROM bookmarks
-        WHERE folder = ?
-        ORDER BY title ASC
+        SELECT folders.id, folders.name,
+            (SELECT COUNT(*) FROM folder_closure
+             JOIN bookmarks ON bookmarks.folder_id = folder_closure.descendant_id
+             WHERE folder_closure.ancestor_id = folders.id),
+            EXISTS (SELECT 1 FROM folders AS children
+                    JOIN folder_closure ON folder_closure.ancestor_id = children.id
+                    JOIN bookmarks ON bookmarks.folder_id = folder_closure.descendant_id
+                    WHERE children.parent_id = folders.id)
+        FROM folders
+        WHERE folders.parent_id IS ?
+        ORDER BY folders.name ASC
         """
 
-        self.cursor.execute(query, (category,))
-        return [Bookmark(record) for record in self.cursor.fetchall()]
+        self.cursor.execute(query, (parent_id,))
+        return self.cursor.fetchall()
+
+    def get_bookmarks_by_folder(self, folder_id):
+        """Returns a pager over all bookmarks in a folder and its subfolders"""
+        return BookmarkPager(self, "folder_id IN (SELECT descendant_id FROM folder_closure WHERE ancestor_id = ?)", (folder_id,))
 
     def get_all_bookmarks(self):
-        """Returns all bookmarks"""
-        query = """
-        SELECT * FROM bookmarks
-        ORDER BY title ASC
-        """
-
-        self.cursor.execute(query)
-        return [Bookmark(record) for record in self.cursor.fetchall()]
+        """Returns a pager over all bookmarks"""
+        return BookmarkPager(self)
 
     def get_distinct_years(self):
         """Returns a list of distinct years"""
+        # Hop from year to year using the add_date index, one seek per year instead of a full scan
         query = """
-        SELECT DISTINCT strftime('%Y', add_date) FROM bookmarks
-        ORDER BY strftime('%Y', add_date) DESC
+        WITH RECURSIVE years(year) AS (
+            SELECT substr(MAX(add_date), 1, 4) FROM bookmarks
+            UNION ALL
+            SELECT (SELECT substr(MAX(add_date), 1, 4) FROM bookmarks WHERE add_date < years.year)
+            FROM years
+            WHERE years.year IS NOT NULL
+        )
+        SELECT year FROM years
+        WHERE year IS NOT NULL
         """
 
         self.cursor.execute(query)
@@ -283,24 +908,303 @@ class Database():
 
     def get_distinct_months(self, year):
         """Returns a list of distinct months for a year"""
+        # Check each month for a bookmark with a range seek
+        months = [f"{month:02d}" for month in range(1, 13)]
         query = """
-        SELECT DISTINCT strftime('%m', add_date) FROM bookmarks
-        WHERE strftime('%Y', add_date) = ?
-        ORDER BY strftime('%m', add_date) ASC
+        SELECT EXISTS (SELECT 1 FROM bookmarks WHERE add_date >= ? AND add_date < ?)
         """
 
-        self.cursor.execute(query, (year,))
-        return [month[0] for month in self.cursor.fetchall()]
+        results = []
+        for month in months:
+            self.cursor.execute(query, month_range(year, month))
+            if self.cursor.fetchone()[0]:
+                results.append(month)
+        return results
 
 
     def get_bookmarks_by_year_month(self, year, month):
-        """Returns all bookmarks in a year - most recent first"""
-        query = """
-        SELECT * FROM bookmarks
-        WHERE strftime('%Y', add_date) = ?
-        AND strftime('%m', add_date) = ?
-        ORDER BY strftime(add_date) DESC
+        """Returns a pager over all bookmarks in a month - most recent first"""
+        return BookmarkPager(self, "add_date >= ? AND add_date < ?", month_range(year, month), order='add_date', descending=True)
+
+class BookmarkPager():
+    """Read only list of the bookmarks matching a where statement
+    Only a window of rows around the ones asked for is held in memory,
+    windows are fetched with keyset pagination on (order column, id) starting from the closest row we know
+    A missing value sorts as '' because comparing anything with NULL is never true"""
+    def __init__(self, database, where=None, params=(), order='title', descending=False, prefetch=PAGE_PREFETCH):
+        self.database = database
+        self.where = where
+        self.params = tuple(params)
+        self.order = order
+        self.descending = descending
+        self.prefetch = prefetch
+
+        # The current window, rows[i] is row number start + i
+        self.start = 0
+        self.rows = []
+
+        query = "SELECT COUNT(*) FROM bookmarks" + self.where_clause([])
+        self.count = self.fetch(query, self.params)[0][0]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+            self.ensure(start, stop)
+            return self.rows[start - self.start:stop - self.start]
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("bookmark index out of range")
+        self.ensure(index, index + 1)
+        return self.rows[index - self.start]
+
+    def __iter__(self):
+        # Walk through a window at a time
+        step = self.prefetch * 2
+        for start in range(0, self.count, step):
+            yield from self[start:start + step]
+
+    def fetch(self, query, params):
+        """Run a query on the database and return the rows"""
+        if not self.database.database_is_connected():
+            self.database.open_database()
+        self.database.cursor.execute(query, params)
+        return self.database.cursor.fetchall()
+
+    def where_clause(self, conditions):
+        """Combine our where statement with any extra conditions"""
+        if self.where:
+            conditions = [f"({self.where})"] + conditions
+        return " WHERE " + " AND ".join(conditions) if conditions else ""
+
+    def key(self, bookmark):
+        """The keyset pagination key for a bookmark"""
+        value = getattr(bookmark, self.order)
+        return ('' if value is None else value, bookmark.id)
+
+    def ensure(self, start, stop):
+        """Make sure rows start to stop are in the window"""
+        if self.start <= start and stop <= self.start + len(self.rows):
+            return
+        self.load(max(0, start - self.prefetch), min(self.count, stop + self.prefetch))
+
+    def load(self, start, stop):
+        """Replace the window with rows start to stop"""
+        # Places we can start reading from as (rows to skip, key to start after, reading forwards)
+        # We can always start from either end of the list
+        candidates = [(start, None, True), (self.count - stop, None, False)]
+        # Or from the ends of the current window
+        if self.rows:
+            first = self.start
+            last = self.start + len(self.rows) - 1
+            if start > first:
+                candidates.append((start - first - 1, self.key(self.rows[0]), True))
+            if start > last:
+                candidates.append((start - last - 1, self.key(self.rows[-1]), True))
+            if stop <= last:
+                candidates.append((last - stop, self.key(self.rows[-1]), False))
+            if stop <= first:
+                candidates.append((first - stop, self.key(self.rows[0]), False))
+        offset, key, forwards = min(candidates, key=lambda candidate: candidate[0])
+
+        # Reading forwards means reading in display order
+        ascending = forwards != self.descending
+        direction = "ASC" if ascending else "DESC"
+        column = f"COALESCE(bookmarks.{self.order}, '')"
+        conditions = []
+        params = list(self.params)
+        if key is not None:
+            comparison = ">" if ascending else "<"
+            # SQLite won't seek on an expression index with just the row value, the first comparison is for that
+            conditions.append(f"{column} {comparison}= ?")
+            conditions.append(f"({column}, bookmarks.id) {comparison} (?, ?)")
+            params += [key[0], *key]
+
+        query = f"""
+        SELECT * FROM bookmarks{self.where_clause(conditions)}
+        ORDER BY {column} {direction}, bookmarks.id {direction}
+        LIMIT ? OFFSET ?
         """
+        params += [stop - start, offset]
+
+        rows = [Bookmark(record) for record in self.fetch(query, params)]
+        if not forwards:
+            rows.reverse()
+        self.start = start
+        self.rows = rows
+
+class DescriptionWriter():
+    """Buffers description rows and writes them to the database in batches
+    Each batch is one executemany in a single transaction
+    Rows are appended to a journal file first so nothing is lost if we crash before a flush,
+    the journal is replayed the next time a writer is created
+    Rows can have extra values on the end for the tagger, like word counts, which aren't written
+    tagger is called with each batch before it's written and returns the rows with tags filled in"""
+    def __init__(self, database, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS, tagger=None):
+        self.database = database
+        self.tagger = tagger
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.journal_path = get_journal_path(database.db_path)
+
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+        # Recover anything left over from last time before we start writing a new journal
+        self.replay()
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        atexit.register(self.close)
+
+    def replay(self):
+        """Insert any rows left in the journal by a previous run"""
+        if not os.path.exists(self.journal_path):
+            return
+
+        rows = []
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rows.append(tuple(json.loads(line)))
+                except json.JSONDecodeError:
+                    # The last line can be cut short if we died mid write
+                    logging.warning("Skipping partial line in descriptions journal")
+
+        if rows:
+            logging.info(f"Replaying {len(rows)} descriptions from the journal")
+            self.database.insert_descriptions(self.tag(rows))
+        os.remove(self.journal_path)
+
+    def add(self, rows):
+        """Add rows of the form (bookmark_id, content, relevant_content, description, tags)"""
+        if not rows:
+            return
+        for row in rows:
+            self.journal.write(json.dumps(row) + '\n')
+        # Flushing to the OS is enough to survive the process dying, we don't fsync every row
+        self.journal.flush()
+
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def tick(self):
+        """Flush the buffer if it's been sat there long enough, call this regularly"""
+        if self.buffer and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write everything in the buffer to the database"""
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+
+        self.database.insert_descriptions(self.tag(self.buffer))
+        logging.info(f"Flushed {len(self.buffer)} descriptions to the database")
+        self.buffer = []
+
+        # Everything in the journal is in the database now
+        self.journal.truncate(0)
+
+    def tag(self, rows):
+        """Run the tagger over a batch and return the rows ready to write
+        The rows still get written without tags if it fails"""
+        if self.tagger is not None:
+            try:
+                return self.tagger(rows)
+            except Exception as e:
+                logging.error(f"Failed to tag descriptions: {e}")
+                # Don't leave half a batch of word counts to be committed with the rows
+                if self.database.database_is_connected():
+                    self.database.db.rollback()
+        return [tuple(row[:5]) for row in rows]
+
+    def close(self):
+        """Flush anything left and remove the journal"""
+        if self.journal.closed:
+            return
+        self.flush()
+        self.journal.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+def clear_samplers(db_path, table=None):
+    """Forget the cached random bookmark ids for a database, or just the ones whose restrictions use a table"""
+    db_path = os.path.abspath(db_path)
+    for key in [key for key in samplers if key[0] == db_path and (table is None or (key[1] is not None and table in key[1]))]:
+        del samplers[key]
+
+def split_tags(tags):
+    """Split a comma separated tags string into a list"""
+    if not tags:
+        return []
+    return [tag.strip() for tag in tags.split(',') if tag.strip()]
+
+def tag_restriction(tag):
+    """Returns a where statement restricting bookmarks to a tag, for use with get_random_bookmark"""
+    tag = tag.replace("'", "''")
+    return f"bookmarks.id IN (SELECT bookmark_id FROM bookmark_tags JOIN tags ON tags.id = bookmark_tags.tag_id WHERE tags.name = '{tag}')"
+
+def search_query(text):
+    """Turn what's been typed into an FTS5 query, or None if there's nothing to search for
+    Every word has to match and the last one can be a prefix, quoting means the user can't write a broken query"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if not text[-1].isspace():
+        terms[-1] += '*'
+    return " ".join(terms)
+
+def format_add_date(add_date):
+    """Returns add_date the way it's stored, 'YYYY-MM-DD HH:MM:SS'
+    The parsers give us datetimes, anything else is assumed to be stored already"""
+    if isinstance(add_date, datetime):
+        return add_date.strftime(ADD_DATE_FORMAT)
+    return add_date
+
+def get_folder_path(bookmark):
+    """Returns the folder path of a bookmark tuple, older tuples only have the folder name"""
+    return tuple(bookmark[4]) if len(bookmark) > 4 else (bookmark[3],)
+
+def fingerprint_file(file_path):
+    """Returns a hash of a file's contents, read a chunk at a time"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def folder_restriction(folder_id):
+    """Returns a where statement restricting bookmarks to a folder and its subfolders, for use with get_random_bookmark"""
+    return f"folder_id IN (SELECT descendant_id FROM folder_closure WHERE ancestor_id = {int(folder_id)})"
+
+def month_range(year, month):
+    """Returns the (start, end) add_date bounds for a month, end is exclusive
+    Month 12 ends at 'YYYY-13' which still sorts after every date in December"""
+    return (f"{year}-{int(month):02d}", f"{year}-{int(month) + 1:02d}")
+
+def month_restriction(year, month):
+    """Returns a where statement restricting bookmarks to a month, for use with get_random_bookmark"""
+    start, end = month_range(year, month)
+    return f"add_date >= '{start}' AND add_date < '{end}'"
+
+def get_journal_path(db_path):
+    """Returns the path of the descriptions journal for a database"""
+    # Not db_path + '-journal' because that's what SQLite calls its own rollback journal
+    return os.path.splitext(db_path)[0] + '_descriptions.journal'
+
+def get_similarity_path(db_path):
+    """Returns the path of the similarity index for a database"""
+    return os.path.splitext(db_path)[0] + '_similarity.npz'
 
-        self.cursor.execute(query, (year,month))
-        return [Bookmark(record) for record in self.cursor.fetchall()]
+def get_lsh_path(db_path):
+    """Returns the path of the LSH tables for a database"""
+    return os.path.splitext(db_path)[0] + '_lsh.npy'
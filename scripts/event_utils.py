@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import curses
+import signal
+import logging
+import selectors
+
+# How long to sleep when nothing's happening, states doing background work can ask for less
+IDLE_TIMEOUT = 1.0
+
+# Background threads write a byte to a pipe to wake the main loop up
+# Windows can only select on sockets, there we just poll quickly like we used to
+selector = None
+selectable = False
+if sys.platform != 'win32':
+    try:
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        selector = selectors.DefaultSelector()
+        selector.register(sys.stdin, selectors.EVENT_READ)
+        selector.register(wakeup_read, selectors.EVENT_READ)
+        selectable = True
+    except (AttributeError, ValueError, OSError):
+        # Not logged, this happens on import before the log file is set up
+        pass
+# How often to check for input when we can't select
+POLL_INTERVAL = 0.05
+
+# Set by the SIGWINCH handler, wait() tells curses about the new size
+resized = False
+
+
+def wakeup():
+    """Wake the main loop, safe to call from any thread"""
+    if not selectable:
+        return
+    try:
+        os.write(wakeup_write, b'\0')
+    except BlockingIOError:
+        # The pipe's full so the loop is going to wake up anyway
+        pass
+
+def on_resize(signum, frame):
+    """SIGWINCH handler, runs on the main thread between bytecodes so just make a note and wake the loop"""
+    global resized
+    resized = True
+    wakeup()
+
+def watch_resize():
+    """Wake the main loop when the terminal is resized, call this after curses has started
+    Otherwise select carries on waiting after the signal and the resize isn't drawn until the timeout
+    This replaces curses' own handler, so wait() calls resizeterm which queues the KEY_RESIZE instead"""
+    if selectable and hasattr(signal, 'SIGWINCH'):
+        signal.signal(signal.SIGWINCH, on_resize)
+
+def wait(timeout=IDLE_TIMEOUT):
+    """Block until there's a key press, a wakeup or the timeout runs out"""
+    global selectable, resized
+    if not selectable:
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return
+    try:
+        selector.select(timeout)
+    except OSError as e:
+        # Something we registered can't be selected on after all
+        logging.warning(f"Can't wait on input, polling instead: {e}")
+        selectable = False
+        return
+    # Empty the pipe so the next wait blocks again
+    try:
+        while os.read(wakeup_read, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    if resized:
+        resized = False
+        try:
+            columns, lines = os.get_terminal_size(sys.__stdout__.fileno())
+            curses.resizeterm(lines, columns)
+        except (OSError, curses.error) as e:
+            logging.warning(f"Failed to resize: {e}")
@@ -0,0 +1,85 @@
+import os
+import logging
+import queue
+import threading
+from collections import deque
+from scripts.event_utils import wakeup
+
+# How many directories down from the start we look
+MAX_DEPTH = 4
+# Directories that never have bookmarks in them, hidden directories are skipped too
+IGNORED_DIRS = {'logs', '__pycache__', 'node_modules', 'venv', 'env', 'site-packages'}
+BOOKMARKS_EXTENSIONS = ('.html', '.htm')
+# Chrome (and everyone else) exports start with this
+BOOKMARKS_DOCTYPE = b'<!doctype netscape-bookmark-file-1>'
+SNIFF_BYTES = 512
+
+
+def is_bookmarks_file(file_path):
+    """Check the start of a file for the Netscape bookmarks doctype"""
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    except OSError:
+        return False
+    # Skip any byte order mark and whitespace
+    head = head.lstrip(b'\xef\xbb\xbf').lstrip()
+    return head.lower().startswith(BOOKMARKS_DOCTYPE)
+
+def scan_bookmarks_files(root, max_depth=MAX_DEPTH):
+    """Yields (filename, path) for every bookmarks export under root
+    Directories are scanned breadth first so files near the top turn up first"""
+    directories = deque([(root, 0)])
+    while directories:
+        directory, depth = directories.popleft()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if depth < max_depth and not entry.name.startswith('.') and entry.name not in IGNORED_DIRS:
+                                directories.append((entry.path, depth + 1))
+                        elif entry.name.lower().endswith(BOOKMARKS_EXTENSIONS) and entry.is_file() and is_bookmarks_file(entry.path):
+                            yield entry.name, entry.path
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.info(f"Couldn't scan directory: {e}")
+
+class BookmarksFileFinder():
+    """Runs scan_bookmarks_files on a background thread
+    Files are put on a queue which the caller drains with poll()"""
+    def __init__(self, root, max_depth=MAX_DEPTH):
+        self.root = root
+        self.max_depth = max_depth
+        self.results = queue.Queue()
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start looking in the background"""
+        self.thread = threading.Thread(target=self.scan, name='bookmarks-finder', daemon=True)
+        self.thread.start()
+
+    def scan(self):
+        try:
+            for result in scan_bookmarks_files(self.root, self.max_depth):
+                self.results.put(result)
+                wakeup()
+        finally:
+            self.done.set()
+            wakeup()
+
+    def finished(self):
+        """Returns true once the scan is done and everything has been polled"""
+        return self.done.is_set() and self.results.empty()
+
+    def poll(self):
+        """Returns all the (filename, path) tuples found since the last poll"""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return results
@@ -0,0 +1,82 @@
+from time import perf_counter
+
+# How long one go at matching can take, a frame at 60fps is about 16ms
+WORK_BUDGET = 0.008
+# Items checked between looking at the clock
+CHUNK = 2000
+
+
+class FuzzyFilter():
+    """Narrows a list of strings down to the ones with the query's characters in them in order (case insensitive)
+    Every character of the query gets its own level of (indices, positions) where positions is how far into
+    each item the match got, so typing another character only checks the last level's matches from there on
+    and backspace just drops a level
+    Matching is done a slice at a time with work() so a huge list never holds up a keypress"""
+    def __init__(self, texts):
+        self.texts = texts
+        # Lowercased texts, filled in by the first character's pass
+        self.lowered = [None] * len(texts)
+        self.query = ""
+        self.levels = []
+        # (indices, positions, cursor) for the level being worked out
+        self.pending = None
+
+    def set_query(self, query):
+        """Change the query, levels for the part that's the same are kept"""
+        query = query.lower()
+        common = 0
+        while common < min(len(query), len(self.levels)) and query[common] == self.query[common]:
+            common += 1
+        del self.levels[common:]
+        self.query = query
+        self.pending = None
+
+    def done(self):
+        return len(self.levels) == len(self.query)
+
+    def work(self, budget=WORK_BUDGET):
+        """Carry on matching for up to budget seconds, returns True once the whole query is matched"""
+        deadline = perf_counter() + budget
+        texts = self.texts
+        lowered = self.lowered
+
+        while not self.done():
+            char = self.query[len(self.levels)]
+            if self.levels:
+                source_indices, source_positions = self.levels[-1]
+            else:
+                source_indices, source_positions = range(len(texts)), None
+            indices, positions, cursor = self.pending or ([], [], 0)
+
+            while cursor < len(source_indices):
+                stop = cursor + CHUNK
+                if source_positions is None:
+                    for i in source_indices[cursor:stop]:
+                        text = lowered[i] = texts[i].lower()
+                        position = text.find(char)
+                        if position >= 0:
+                            indices.append(i)
+                            positions.append(position + 1)
+                else:
+                    for i, start in zip(source_indices[cursor:stop], source_positions[cursor:stop]):
+                        position = lowered[i].find(char, start)
+                        if position >= 0:
+                            indices.append(i)
+                            positions.append(position + 1)
+                cursor = min(stop, len(source_indices))
+                if cursor < len(source_indices) and perf_counter() > deadline:
+                    self.pending = (indices, positions, cursor)
+                    return False
+
+            self.levels.append((indices, positions))
+            self.pending = None
+        return True
+
+    def matches(self):
+        """Indices of the matching items in list order
+        While work() is still going this is the matches found so far, which are the ones at the top of the list"""
+        if self.pending is not None:
+            return self.pending[0]
+        if self.levels:
+            return self.levels[-1][0]
+        return range(len(self.texts))
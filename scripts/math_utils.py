@@ -1,3 +1,5 @@
+from random import randrange
+
 def clamp(n, min, max):
     if n < min:
         return min
@@ -5,3 +7,33 @@ def clamp(n, min, max):
         return max
     else:
         return n
+
+
+class ShuffleBag():
+    """Hands out items in a random order with no repeats until every item has been drawn, then starts again
+    This is a Fisher-Yates shuffle done one draw at a time so each draw is O(1)"""
+    def __init__(self, items):
+        # Drawn items are swapped to the end, items[:remaining] are the ones left
+        self.items = items
+        self.remaining = len(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def draw(self):
+        """Returns the next item"""
+        if not self.items:
+            return None
+
+        if self.remaining == 0:
+            # Start again with everything, the last item drawn ends up at the front so put it at the back
+            # and leave it out of the first draw so it can't come out twice in a row
+            self.items[0], self.items[-1] = self.items[-1], self.items[0]
+            self.remaining = len(self.items)
+            index = randrange(self.remaining - 1) if self.remaining > 1 else 0
+        else:
+            index = randrange(self.remaining)
+
+        self.remaining -= 1
+        self.items[index], self.items[self.remaining] = self.items[self.remaining], self.items[index]
+        return self.items[self.remaining]
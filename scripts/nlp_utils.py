@@ -1,30 +1,50 @@
 from nltk.tokenize import word_tokenize as word_tokenise
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer as WordNetLemmatiser
-from nltk import FreqDist
+from functools import lru_cache
+import threading
 import string
 import logging
 
+# How many words to remember the lemma of, most pages use the same few thousand words
+LEMMA_CACHE_SIZE = 100000
+
+# Loaded the first time they're needed, loading the nltk corpora is slow
+stop_words = None
+lemmatiser = None
+resources_lock = threading.Lock()
+punctuation_table = str.maketrans('', '', string.punctuation)
+
+def load_resources():
+    """Load the stopwords and lemmatiser once, the scraper calls clean_text from lots of threads"""
+    global stop_words, lemmatiser
+    if lemmatiser is not None:
+        return
+    with resources_lock:
+        if lemmatiser is None:
+            stop_words = frozenset(stopwords.words('english'))
+            new_lemmatiser = WordNetLemmatiser()
+            # Wordnet is loaded lazily and that isn't thread safe so get it done here
+            new_lemmatiser.lemmatize('words')
+            lemmatiser = new_lemmatiser
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatise(word):
+    return lemmatiser.lemmatize(word)
+
+def clean_words(text):
+    """Yields the cleaned words of a text in a single pass:
+    lowercased, punctuation removed, alphabetic only, no stopwords, lemmatised"""
+    load_resources()
+    for token in word_tokenise(text):
+        word = token.lower().translate(punctuation_table)
+        if word.isalpha() and word not in stop_words:
+            yield lemmatise(word)
+
 def clean_text(text):
-    tokens = word_tokenise(text)
-    # Lowercase
-    tokens = [w.lower() for w in tokens]
-    # Remove punctuation
-    table = str.maketrans('', '', string.punctuation)
-    stripped = [w.translate(table) for w in tokens]
-    # Remove non-alphabetic tokens
-    words = [word for word in stripped if word.isalpha()]
-    # Remove stopwords
-    stop_words = set(stopwords.words('english'))
-    words = [w for w in words if not w in stop_words]
-    # Lemmatize
-    lemmatizer = WordNetLemmatiser()
-    words = [lemmatizer.lemmatize(word) for word in words]
-    return words
+    return list(clean_words(text))
 
-def get_tags(words, n_tags=5):
-    """Use frequency distribution to get the most common words"""
-    freq_dist = FreqDist(words)
-    tags = freq_dist.most_common(n_tags)
-    tags = [tag[0] for tag in tags]
-    return tags if tags else None
+def clean_texts(texts):
+    """Yields the cleaned words of each text as a list, for cleaning lots of pages"""
+    for text in texts:
+        yield list(clean_words(text))
@@ -0,0 +1,151 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scripts.scraping_utils import scrape_data, get_host
+from scripts.event_utils import wakeup
+
+# Defaults for the engine, these can be overridden when the engine is created
+# Concurrency is the number of pages being scraped at once
+MAX_WORKERS = 16
+# Don't hammer any one server, most of my bookmarks are on a handful of sites
+PER_HOST_LIMIT = 2
+# Overall throughput limit (new requests started per second), None for no limit
+MAX_REQUESTS_PER_SECOND = 20
+
+
+class ScrapingEngine():
+    """Scrapes bookmarks on a pool of background threads
+    Bookmarks are (id, url) tuples as returned by get_null_description_bookmarks
+    Results are put on a queue which the caller drains with poll()
+    prepare is run on each scraped page on the worker thread, so slow work like cleaning the text stays off the main loop"""
+    def __init__(self, bookmarks, max_workers=MAX_WORKERS, per_host_limit=PER_HOST_LIMIT, max_requests_per_second=MAX_REQUESTS_PER_SECOND, prepare=None):
+        self.prepare = prepare
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.min_interval = 1 / max_requests_per_second if max_requests_per_second else 0
+
+        # Group the bookmarks by host, we hand them out round robin so no one host holds up the rest
+        self.pending = {}
+        for bookmark in bookmarks:
+            self.pending.setdefault(get_host(bookmark[1]), deque()).append(bookmark)
+        self.hosts = deque(self.pending.keys())
+
+        self.total = len(bookmarks)
+        self.received = 0
+
+        # Book keeping for the dispatcher, guarded by the condition
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.host_counts = {}
+        self.stopping = False
+
+        self.results = queue.Queue()
+        self.executor = None
+        self.dispatcher = None
+
+    def start(self):
+        """Start scraping in the background"""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scraper')
+        self.dispatcher = threading.Thread(target=self.dispatch, name='scraper-dispatcher', daemon=True)
+        self.dispatcher.start()
+        # Make sure we don't hang around waiting for workers on exit
+        atexit.register(self.stop)
+        logging.info(f"Scraping engine started: {self.total} bookmarks, {self.max_workers} workers, {self.per_host_limit} per host")
+
+    def stop(self):
+        """Stop handing out new work, anything in flight is left to finish"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def finished(self):
+        """Returns true once every bookmark has a result"""
+        return self.received >= self.total
+
+    def poll(self):
+        """Returns all results that have come in since the last poll
+        Each result is a tuple of (bookmark, page_contents)"""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.received += len(results)
+        return results
+
+    def next_bookmark(self):
+        """Returns the next bookmark whose host is under the per host limit, or None
+        Must be called with the condition held"""
+        for _ in range(len(self.hosts)):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if self.host_counts.get(host, 0) >= self.per_host_limit:
+                continue
+            bookmarks = self.pending[host]
+            bookmark = bookmarks.popleft()
+            if not bookmarks:
+                # Nothing left for this host so drop it from the rotation
+                del self.pending[host]
+                self.hosts.remove(host)
+            return host, bookmark
+        return None
+
+    def dispatch(self):
+        """Hands bookmarks to the worker pool while respecting all the limits"""
+        next_request = time.monotonic()
+        with self.condition:
+            while not self.stopping and self.hosts:
+                # Concurrency limit
+                if self.in_flight >= self.max_workers:
+                    self.condition.wait()
+                    continue
+
+                # Throughput limit
+                delay = next_request - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                # Per host limit - if every host is busy wait for a worker to finish
+                job = self.next_bookmark()
+                if job is None:
+                    self.condition.wait()
+                    continue
+
+                host, bookmark = job
+                self.host_counts[host] = self.host_counts.get(host, 0) + 1
+                self.in_flight += 1
+                next_request = time.monotonic() + self.min_interval
+                self.executor.submit(self.work, host, bookmark)
+
+    def work(self, host, bookmark):
+        """Scrape a single bookmark, runs on a worker thread"""
+        try:
+            page_contents = scrape_data(bookmark)
+        except Exception as e:
+            logging.error(f"Failed to scrape url: {bookmark[1]}")
+            logging.info(f"Error: {e}")
+            page_contents = (bookmark[0], None, None, None, None)
+
+        if self.prepare is not None and page_contents[1] is not None:
+            try:
+                page_contents = self.prepare(page_contents)
+            except Exception as e:
+                logging.error(f"Failed to prepare page: {bookmark[1]}")
+                logging.info(f"Error: {e}")
+
+        self.results.put((bookmark, page_contents))
+        wakeup()
+
+        # Free up the slot for the dispatcher
+        with self.condition:
+            self.in_flight -= 1
+            self.host_counts[host] -= 1
+            self.condition.notify_all()
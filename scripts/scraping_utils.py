@@ -1,8 +1,129 @@
 from requests_html import HTMLSession
+from requests.adapters import HTTPAdapter
+import pyppeteer
+import asyncio
+import atexit
+import threading
 import logging
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
 from scripts.database_utils import Database
-from scripts.nlp_utils import clean_text, get_tags
+
+# Connection pool settings for the shared session
+# pool_connections is how many hosts we keep pools for, pool_maxsize is keep-alive connections per host
+POOL_CONNECTIONS = 64
+POOL_MAXSIZE = 4
+REQUEST_TIMEOUT = 15
+# Number of browser pages kept open for rendering and how long a render can take
+RENDER_PAGES = 4
+RENDER_TIMEOUT = 20
+
+# When to run javascript on a page:
+# 'auto' parses the static html first and only renders pages that look empty
+# 'always' renders every page, 'never' doesn't start the browser at all
+RENDER_MODE = 'auto'
+# Pages with less text than this (and no meta description) probably get filled in by javascript
+MIN_STATIC_TEXT = 200
+# Elements that single page app frameworks mount into, if one of these is empty we need to render
+SPA_ROOTS = [{'id': 'root'}, {'id': 'app'}, {'id': '__next'}, {'id': '__nuxt'}, {'ng-app': True}, {'data-reactroot': True}]
+
+# Remember which hosts needed rendering so we can skip straight to the browser next time
+render_domains = {}
+# Count how many pages were rendered vs parsed from static html
+render_stats = {'rendered': 0, 'static': 0}
+render_stats_lock = threading.Lock()
+
+class Renderer():
+    """A single headless browser shared by every scraper thread
+    The browser runs on its own event loop thread and its pages are reused between renders"""
+    def __init__(self, pages=RENDER_PAGES):
+        self.size = pages
+        self.loop = None
+        self.thread = None
+        self.browser = None
+        self.pages = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the event loop thread and launch the browser"""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='renderer', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.launch(), self.loop).result()
+        logging.info(f"Renderer started with {self.size} pages")
+
+    async def launch(self):
+        """Launch the browser and open the page pool"""
+        # Signal handlers can only be installed from the main thread
+        self.browser = await pyppeteer.launch(headless=True, handleSIGINT=False, handleSIGTERM=False, handleSIGHUP=False)
+        self.pages = asyncio.Queue()
+        for _ in range(self.size):
+            self.pages.put_nowait(await self.browser.newPage())
+
+    async def render_page(self, url):
+        """Borrow a page from the pool, load the url and return the rendered html"""
+        page = await self.pages.get()
+        try:
+            await page.goto(url, timeout=RENDER_TIMEOUT * 1000)
+            return await page.content()
+        finally:
+            # Replace the page if it crashed so the pool doesn't shrink
+            if page.isClosed():
+                page = await self.browser.newPage()
+            self.pages.put_nowait(page)
+
+    def render(self, url):
+        """Render a url and return the html, can be called from any thread"""
+        with self.lock:
+            if self.loop is None:
+                self.start()
+        future = asyncio.run_coroutine_threadsafe(self.render_page(url), self.loop)
+        return future.result(timeout=RENDER_TIMEOUT * 2)
+
+    def close(self):
+        """Close the browser and stop the event loop"""
+        if self.loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.browser.close(), self.loop).result(timeout=RENDER_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Failed to close renderer: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+
+# One session and one renderer for the whole process so connections and the browser get reused
+session = None
+session_lock = threading.Lock()
+renderer = Renderer()
+
+def get_host(url):
+    """Returns the host of a url, used to group requests by server"""
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        host = None
+    # Fall back to the url itself so malformed urls still get grouped
+    return host if host else url
+
+def get_session():
+    """Returns the shared session, creating it on first use"""
+    global session
+    with session_lock:
+        if session is None:
+            session = HTMLSession()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+    return session
+
+@atexit.register
+def close_session():
+    """Close the shared session and the renderer"""
+    global session
+    renderer.close()
+    if session:
+        session.close()
+        session = None
 
 def get_null_description_bookmarks():
     """Returns a list of bookmarks with null descriptions"""
@@ -42,53 +163,37 @@ def get_null_description_bookmarks():
 
 def scrape_data(bookmark_info):
     """Scrapes the page contents and returns a list of tuples of the bookmark id and the page contents"""
-    # Loop through the results and use the requests library to get the page contents
-    session = HTMLSession()
+    # Use the shared session so we keep connections alive between scrapes
+    session = get_session()
 
     # Get the id and url
     bookmark_id, url = bookmark_info
     # Get the description
     try:
-        r = session.get(url)
-        # Render for js content
-        r.html.render()
+        r = session.get(url, timeout=REQUEST_TIMEOUT)
     except:
         logging.error(f"Failed to get url: {url}")
-        session.close()
         return (bookmark_id, None, None, None, None)
 
     if r.status_code == 200:
-        # Make the soup
-        soup = BeautifulSoup(r.text, 'html.parser')
+        # Make the soup, rendering javascript only if the static html isn't good enough
+        soup = get_soup(url, r)
         content_dump = soup.text
         try:
             relevant_content = parse_soup(soup)
         except Exception as e:
             logging.error(f"Failed to parse soup for url: {url}")
-            session.close()
             return (bookmark_id, None, None, None, None)
         try:
             description = get_description(soup)
         except Exception as e:
             logging.error(f"Failed to get description for url: {url}")
             description = None
-        try:
-            # join description and relevant content
-            if description:
-                tag_content = description + ' ' + relevant_content
-            cleaned_text = clean_text(tag_content)
-            tags = get_tags(cleaned_text, n_tags = 3)
-            # Format tags for database
-            tags = ','.join(tags)
-            logging.info(f"Tags for url: {url} are: {tags}")
-        except Exception as e:
-            logging.error(f"Failed to get tags for url: {url}")
-            logging.info(f"Error: {e}")
-            tags = None
+        # Tags are picked in batches against the whole corpus when the rows are written (see tag_utils)
+        tags = None
     else:
         logging.error(f"Failed to get url: {url}")
         logging.info(f"Status code: {r.status_code}")
-        session.close()
         # If status code is 404 then we can tag with 404
         if r.status_code == 404:
             tags = '404'
@@ -103,9 +208,65 @@ def scrape_data(bookmark_info):
         return (bookmark_id, content, None, description, tags)
 
     # Return tuple
-    session.close()
     return (bookmark_id, content_dump, relevant_content, description, tags)
 
+def needs_render(soup):
+    """Guess whether a page needs javascript running to get at its content"""
+    body = soup.find('body')
+    if body is None:
+        body = soup
+
+    # Barely any text and no description to fall back on
+    if len(body.get_text(' ', strip=True)) < MIN_STATIC_TEXT and get_description(soup) is None:
+        return True
+
+    # An empty app root means a framework is going to fill the page in
+    for attrs in SPA_ROOTS:
+        root = soup.find(attrs=attrs)
+        if root is not None and not root.get_text(strip=True):
+            return True
+
+    return False
+
+def count_render(rendered):
+    """Update the render stats"""
+    with render_stats_lock:
+        render_stats['rendered' if rendered else 'static'] += 1
+
+def get_render_stats():
+    """Returns a copy of the render stats"""
+    with render_stats_lock:
+        return dict(render_stats)
+
+def get_soup(url, response):
+    """Returns the soup for a page
+    Depending on RENDER_MODE this parses the static html and only renders the page if it looks empty"""
+    host = get_host(url)
+    render = RENDER_MODE == 'always' or (RENDER_MODE == 'auto' and render_domains.get(host, False))
+
+    soup = None
+    if not render:
+        soup = BeautifulSoup(response.text, 'html.parser')
+        if RENDER_MODE == 'auto' and needs_render(soup):
+            logging.info(f"Static html looks empty, rendering pages from: {host}")
+            render_domains[host] = True
+            render = True
+
+    if render:
+        try:
+            soup = BeautifulSoup(renderer.render(url), 'html.parser')
+            count_render(True)
+            return soup
+        except Exception as e:
+            # Better to have the static html than nothing at all
+            logging.error(f"Failed to render url: {url}")
+            logging.info(f"Error: {e}")
+            if soup is None:
+                soup = BeautifulSoup(response.text, 'html.parser')
+
+    count_render(False)
+    return soup
+
 def parse_soup(soup):
     """Parses the soup and returns the page contents"""
     # We will try get the main content
@@ -0,0 +1,330 @@
+import os
+import logging
+import threading
+import numpy as np
+from scipy import sparse
+from scripts.nlp_utils import clean_texts
+from scripts.database_utils import Database, get_similarity_path, get_lsh_path, delete_listeners
+from scripts.event_utils import wakeup
+
+# How many similar bookmarks to show
+TOP_K = 20
+
+# Past this many bookmarks similar() looks for candidates with LSH instead of comparing against everything
+ANN_THRESHOLD = 5000
+# LSH settings, more bits and more candidates find more of the true neighbours but take longer
+LSH_BITS = 512
+LSH_CANDIDATES = 500
+LSH_SEED = 42
+
+# Indexes by database path, loaded from disk in the background the first time they're asked for
+indexes = {}
+
+
+class SimilarityIndex():
+    """TF-IDF vectors of the scraped relevant_content, for finding similar bookmarks by cosine similarity
+    Raw term counts are what's kept (and saved to disk) so new descriptions can be added without starting again,
+    the weighted and normalised matrix is worked out from them when it's next needed
+    Cleaning the text of a whole corpus takes a while so refresh() does the loading and updating on a background thread,
+    nothing else should touch the index while busy() is true"""
+    def __init__(self, db_path='bookmarks.db'):
+        self.db_path = db_path
+        self.path = get_similarity_path(db_path)
+        self.reset()
+
+        self.loaded = False
+        self.thread = None
+        self.refresh_again = False
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """Start with an empty index"""
+        # One row of term counts per bookmark, bookmark_ids[row] is the bookmark
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self.bookmark_ids = np.zeros(0, dtype=np.int64)
+        self.vocabulary = {}
+        # The highest descriptions.id we've indexed, anything above it is new
+        self.last_description_id = 0
+        # Cached tf-idf matrix, None when it needs working out again
+        self.vectors = None
+        self.rows = {}
+        self.lsh = None
+
+    def load(self):
+        """Load the index from disk if it's been saved before"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as saved:
+                self.counts = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']), shape=tuple(saved['shape']))
+                self.bookmark_ids = saved['bookmark_ids']
+                self.vocabulary = {term: i for i, term in enumerate(saved['vocabulary'].tolist())}
+                self.last_description_id = int(saved['last_description_id'])
+        except Exception as e:
+            logging.warning(f"Failed to load similarity index, it'll be rebuilt: {e}")
+            self.reset()
+            return
+        self.vectors = None
+        self.rows = {bookmark_id: row for row, bookmark_id in enumerate(self.bookmark_ids.tolist())}
+
+    def save(self):
+        """Write the index to disk next to the database"""
+        vocabulary = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str)
+        # np.savez adds .npz to anything that doesn't end with it so write to a temp file that does
+        temp_path = self.path + '.tmp.npz'
+        np.savez(temp_path, data=self.counts.data, indices=self.counts.indices, indptr=self.counts.indptr,
+                 shape=np.array(self.counts.shape), bookmark_ids=self.bookmark_ids, vocabulary=vocabulary,
+                 last_description_id=np.array(self.last_description_id))
+        os.replace(temp_path, self.path)
+
+    def busy(self):
+        """True while the index is being loaded or updated in the background"""
+        return self.thread is not None
+
+    def refresh(self):
+        """Load and update the index on a background thread, the main loop is woken up when it's done
+        If it's already updating it goes round again once it's finished so nothing written in the meantime is missed"""
+        with self.lock:
+            if self.thread is not None:
+                self.refresh_again = True
+                return
+            self.refresh_again = False
+            self.thread = threading.Thread(target=self.run_refresh, name='similarity-index', daemon=True)
+            self.thread.start()
+
+    def run_refresh(self):
+        """Runs on the background thread"""
+        # The persistent connection belongs to the main thread so this gets its own
+        database = Database(self.db_path, persistent=False)
+        try:
+            while True:
+                if not self.loaded:
+                    self.load()
+                    self.loaded = True
+                self.update(database)
+                # Work these out now so finding similar bookmarks takes milliseconds
+                self.get_vectors()
+                if self.counts.shape[0] >= ANN_THRESHOLD:
+                    self.get_lsh()
+
+                with self.lock:
+                    if not self.refresh_again:
+                        self.thread = None
+                        break
+                    self.refresh_again = False
+        except Exception as e:
+            logging.warning(f"Failed to update the similarity index: {e}")
+            with self.lock:
+                self.thread = None
+        finally:
+            database.close_database()
+            wakeup()
+
+    def wait(self):
+        """Block until the background update is done"""
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def update(self, database):
+        """Add any descriptions written since the last update and drop bookmarks that have gone, returns the number added"""
+        if not database.database_is_connected():
+            database.open_database()
+
+        # A rebuilt database starts its ids again
+        database.cursor.execute("SELECT MAX(id) FROM descriptions")
+        max_id = database.cursor.fetchone()[0] or 0
+        if max_id < self.last_description_id:
+            logging.info("Descriptions have gone backwards, rebuilding the similarity index")
+            self.reset()
+
+        query = """
+        SELECT id, bookmark_id, relevant_content FROM descriptions
+        WHERE id > ? AND relevant_content IS NOT NULL AND relevant_content != ''
+        ORDER BY id
+        """
+        database.cursor.execute(query, (self.last_description_id,))
+        records = database.cursor.fetchall()
+        self.last_description_id = max_id
+
+        # Deleting a bookmark deletes its description, so anything without one has gone
+        database.cursor.execute("SELECT bookmark_id FROM descriptions WHERE relevant_content IS NOT NULL AND relevant_content != ''")
+        live = np.array([record[0] for record in database.cursor.fetchall()], dtype=np.int64)
+        # Re-scraped bookmarks get their old rows replaced too
+        keep = np.isin(self.bookmark_ids, live) & ~np.isin(self.bookmark_ids, [record[1] for record in records])
+        removed = int(len(keep) - keep.sum())
+
+        if not records:
+            if removed:
+                self.counts = self.counts[np.flatnonzero(keep)]
+                self.set_bookmark_ids(self.bookmark_ids[keep])
+                self.save()
+                logging.info(f"Removed {removed} deleted bookmarks from the similarity index")
+            return 0
+
+        # Term counts for the new documents as coordinates
+        data, indices, indptr, bookmark_ids = [], [], [0], []
+        for (_, bookmark_id, _), words in zip(records, clean_texts(record[2] for record in records)):
+            terms = {}
+            for word in words:
+                term = self.vocabulary.setdefault(word, len(self.vocabulary))
+                terms[term] = terms.get(term, 0) + 1
+            indices.extend(terms.keys())
+            data.extend(terms.values())
+            indptr.append(len(indices))
+            bookmark_ids.append(bookmark_id)
+
+        new_counts = sparse.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)),
+                                       shape=(len(bookmark_ids), len(self.vocabulary)))
+
+        old_counts = self.counts[np.flatnonzero(keep)]
+        old_counts.resize((old_counts.shape[0], len(self.vocabulary)))
+        self.counts = sparse.vstack([old_counts, new_counts], format='csr')
+        self.set_bookmark_ids(np.concatenate([self.bookmark_ids[keep], np.array(bookmark_ids, dtype=np.int64)]))
+
+        self.save()
+        logging.info(f"Added {len(bookmark_ids)} bookmarks to the similarity index")
+        return len(bookmark_ids)
+
+    def set_bookmark_ids(self, bookmark_ids):
+        """Change which bookmark each row is, after rows have been added or removed"""
+        self.bookmark_ids = bookmark_ids
+        self.rows = {bookmark_id: row for row, bookmark_id in enumerate(self.bookmark_ids.tolist())}
+        self.vectors = None
+        self.lsh = None
+
+    def get_vectors(self):
+        """The tf-idf matrix with unit length rows, so dot products are cosine similarities"""
+        if self.vectors is None:
+            documents = self.counts.shape[0]
+            # Smoothed idf, same as sklearn's
+            document_frequency = np.bincount(self.counts.indices, minlength=self.counts.shape[1])
+            idf = np.log((1 + documents) / (1 + document_frequency)) + 1
+
+            vectors = self.counts.copy()
+            # Sublinear tf so one word repeated all over a page doesn't swamp everything else
+            vectors.data = 1 + np.log(vectors.data)
+            vectors = vectors.multiply(idf.astype(np.float32)).tocsr()
+            norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+            norms[norms == 0] = 1
+            self.vectors = sparse.diags(1 / norms).dot(vectors).tocsr()
+        return self.vectors
+
+    def get_lsh(self):
+        """The LSH sketches for the current vectors, loaded from disk if they're up to date"""
+        if self.lsh is None:
+            lsh = LSHIndex(self.db_path)
+            # Sketches saved after the index was are still good
+            if not lsh.load(self.counts.shape[0], os.path.getmtime(self.path) if os.path.exists(self.path) else 0):
+                lsh.build(self.get_vectors())
+                lsh.save()
+            self.lsh = lsh
+        return self.lsh
+
+    def similar(self, bookmark_id, k=TOP_K, exact=None):
+        """Returns up to k (bookmark_id, similarity) tuples, most similar first
+        Big indexes only score the candidates LSH comes up with unless exact is True"""
+        row = self.rows.get(bookmark_id)
+        if row is None:
+            return []
+
+        if exact is None:
+            exact = self.counts.shape[0] < ANN_THRESHOLD
+        vectors = self.get_vectors()
+        if exact:
+            scores = vectors.dot(vectors[row].T).toarray().ravel()
+            scores[row] = 0
+            return self.top(scores, np.arange(len(scores)), k)
+
+        candidates = self.get_lsh().candidates(row)
+        candidates = candidates[candidates != row]
+        scores = vectors[candidates].dot(vectors[row].T).toarray().ravel()
+        return self.top(scores, candidates, k)
+
+    def top(self, scores, rows, k):
+        """The k best scoring rows as (bookmark_id, similarity) tuples"""
+        # Only sort the top k
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.bookmark_ids[rows[i]]), float(scores[i])) for i in top if scores[i] > 0]
+
+class LSHIndex():
+    """Random projection LSH (SimHash) sketches of the tf-idf vectors
+    Each bookmark gets one bit per random hyperplane, the sign of its dot product with it. The fraction of bits two
+    sketches differ in estimates the angle between the vectors, so the closest sketches by Hamming distance are
+    the candidates and only those get scored exactly
+    Sketches are packed into 64 bit words (64 bytes a bookmark at 512 bits) and saved as a .npy that's memory mapped on load"""
+    def __init__(self, db_path='bookmarks.db', bits=LSH_BITS, candidates=LSH_CANDIDATES, seed=LSH_SEED):
+        self.path = get_lsh_path(db_path)
+        self.bits = bits
+        self.candidate_count = candidates
+        self.seed = seed
+        self.sketches = None
+
+    def build(self, vectors):
+        """Sketch every vector, 64 hyperplanes at a time to keep the projection small"""
+        rng = np.random.default_rng(self.seed)
+        words = []
+        for _ in range(self.bits // 64):
+            hyperplanes = rng.standard_normal((vectors.shape[1], 64)).astype(np.float32)
+            signs = np.asarray(vectors.dot(hyperplanes)) > 0
+            words.append(np.packbits(signs, axis=1).view(np.uint64))
+        self.sketches = np.ascontiguousarray(np.hstack(words))
+
+    def save(self):
+        """Write the sketches to disk"""
+        temp_path = self.path + '.tmp.npy'
+        np.save(temp_path, self.sketches)
+        os.replace(temp_path, self.path)
+
+    def load(self, rows, not_before=0):
+        """Memory map the saved sketches, returns False if there aren't any or they're older than not_before"""
+        if not os.path.exists(self.path) or os.path.getmtime(self.path) < not_before:
+            return False
+        try:
+            sketches = np.load(self.path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to load LSH sketches: {e}")
+            return False
+        if sketches.shape != (rows, self.bits // 64):
+            return False
+        self.sketches = sketches
+        return True
+
+    def candidates(self, row):
+        """The rows whose sketches are closest to row's"""
+        distances = popcount(self.sketches ^ self.sketches[row]).sum(axis=1)
+        count = min(self.candidate_count, len(distances))
+        if count == len(distances):
+            return np.arange(count)
+        return np.argpartition(distances, count - 1)[:count]
+
+# Bits set in each byte, for numpy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(words):
+    """Number of bits set in each 64 bit word"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+def get_similarity_index(db_path):
+    """Returns the index for a database, it's loaded and brought up to date in the background the first time
+    Check busy() before using it"""
+    path = os.path.abspath(db_path)
+    if path not in indexes:
+        indexes[path] = SimilarityIndex(db_path)
+        indexes[path].refresh()
+    return indexes[path]
+
+def refresh_similarity_index(db_path):
+    """Bring a database's index up to date in the background, if it's been asked for"""
+    index = indexes.get(os.path.abspath(db_path))
+    if index is not None:
+        index.refresh()
+
+# Deleted bookmarks come out of the index on its next update
+delete_listeners.append(refresh_similarity_index)
@@ -6,16 +6,17 @@ import webbrowser
 from random import choice
 from datetime import datetime
 from enum import Enum
-from scripts.database_utils import Database
-from scripts.chrome_bookmarks_parser import parse
-from scripts.components import Menu, MenuList, Bookmark
+from scripts.database_utils import Database, DescriptionWriter, delete_database, fingerprint_file, tag_restriction, month_restriction, folder_restriction, HIGHLIGHT_START, HIGHLIGHT_END
+from scripts.chrome_bookmarks_parser import BookmarksParser
+from scripts.chrome_json_parser import BookmarksReader, BookmarksWatcher, get_chrome_bookmarks_path
+from scripts.components import Menu, MenuList, PagedItems, Bookmark
 from scripts.colours import Colours
-from scripts.scraping_utils import main as scrape_data
-from scripts.scraping_utils import get_null_description_bookmarks
-
-# OPTIONAL:
-# TODO: Build recommender engine using cosine similarity
-# TODO: Do I really want to do that lol
+from scripts.scraping_utils import get_null_description_bookmarks, get_render_stats
+from scripts.scraping_engine import ScrapingEngine
+from scripts.file_utils import BookmarksFileFinder, BOOKMARKS_EXTENSIONS
+from scripts.similarity_utils import get_similarity_index, refresh_similarity_index
+from scripts.tag_utils import TagEngine, add_word_counts, start_corpus_count
+from scripts.event_utils import IDLE_TIMEOUT
 
 # TODO: I dunno setup an option so we can browse from Lynx or something
 
@@ -24,6 +25,8 @@ state_history = []
 
 # Globals
 database = None
+# Set when the database is built from Chrome's own Bookmarks file, keeps it in sync
+watcher = None
 month_names = {
     "01": "January",
     "02": "February",
@@ -59,13 +62,34 @@ class MenuFunction():
     Define function type from enum
     If type is FUNCTION then pass a function to the function argument along with any args
     If type is ADVANCE_STATE then pass a state to the state argument
-    If type is REGRESS_STATE then nothing is needed other than the type"""
+    If type is REGRESS_STATE then nothing is needed other than the type
+    Any of the args can be Deferred, these are only worked out when the function is performed"""
     def __init__(self, function_type, function=None, args=[], state=None):
         self.type = function_type
         self.function = function
         self.args = args
         self.state = state
 
+    def get_args(self):
+        """Returns the args with any deferred ones loaded"""
+        return [arg.resolve() if isinstance(arg, Deferred) else arg for arg in self.args]
+
+class Deferred():
+    """A menu function argument that is loaded when the menu item is selected rather than when the menu is built
+    The result is cached so selecting the same item again doesn't run the query again"""
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.loaded = False
+        self.value = None
+
+    def resolve(self):
+        """Load the value if we haven't already"""
+        if not self.loaded:
+            self.value = self.function(*self.args)
+            self.loaded = True
+        return self.value
+
 class State():
     """Base class for all states"""
     def __init__(self, stdscr):
@@ -87,14 +111,26 @@ class State():
         # Set up colours
         self.colours = Colours()
 
-    def update(self):
-        """Update the state"""
+        # The main loop only redraws after a key press, a state change or when dirty is set
+        # and sleeps for up to timeout seconds waiting for something to happen
+        self.dirty = True
+        self.timeout = IDLE_TIMEOUT
+
+    def update(self, key=None):
+        """Update the state
+        key is passed to the menu if the state has already read the keyboard"""
+        # Pick up any changes to Chrome's bookmarks
+        if watcher:
+            watcher.poll()
+
         # These are one time functions that are called when we regress to a prior state
         # Useful for passing data between states
         if self.on_regress:
             # This also allows us to change states on regress by providing a return value
             func = self.on_regress
             self.on_regress = None
+            # Callbacks usually change what's on screen
+            self.dirty = True
             return_value = func()
             if return_value:
                 return return_value
@@ -103,11 +139,16 @@ class State():
             val = self.update_function(*self.update_function_args)
             self.update_function = None
             self.update_function_args = []
+            self.dirty = True
             if val:
                 return val
 
         if self.menu:
-            callback = self.menu.update()
+            callback = self.menu.update(key)
+            # The menu can have something new to show without a key press, like a filter that's still matching
+            if self.menu.dirty:
+                self.menu.dirty = False
+                self.dirty = True
             if callback:
                 logging.info(f"Menu function called: {callback}")
                 logging.info(f"Menu function type: {callback.type}")
@@ -124,13 +165,13 @@ class State():
         # Check the function type
         if function.type == FunctionType.ADVANCE_STATE:
             # Advance to the new state
-            return self.advance_state(function.state, function.args)
+            return self.advance_state(function.state, function.get_args())
         elif function.type == FunctionType.REGRESS_STATE:
             # Regress to the previous state
-            return self.regress_state(*function.args)
+            return self.regress_state(*function.get_args())
         elif function.type == FunctionType.FUNCTION:
             # Call the function
-            function.function(*function.args)
+            function.function(*function.get_args())
             return None
 
 
@@ -140,6 +181,11 @@ class State():
         if self.menu:
             self.menu.render()
 
+    def refresh(self):
+        """Put anything drawn in its own window onto the screen, called after stdscr is refreshed"""
+        if self.menu:
+            self.menu.refresh()
+
     def advance_state(self, state, args=[]):
         """Advance to a new state"""
         # This just needs to return state, logic is handled in update() to pass the new state to the main loop
@@ -179,17 +225,21 @@ class StateSetup(State):
         self.timer = 0
         self.t = datetime.now()
 
-    def update(self):
+    def update(self, key=None):
         """Update the state"""
         # Update timer if necessary
         if self.timer > 0:
             dt = datetime.now() - self.t
             self.timer -= dt.total_seconds()
             self.t = datetime.now()
+            # Wake up in time to take the message down
+            self.timeout = max(self.timer, 0)
             if self.timer <= 0:
                 self.display_message = None
+                self.timeout = IDLE_TIMEOUT
+                self.dirty = True
 
-        return super().update()
+        return super().update(key)
 
 
     def render(self):
@@ -205,6 +255,7 @@ class StateSetup(State):
     def on_db_update(self):
         """Callback for when the database is updated - used to display a message to the user"""
         self.timer = self.timer_max
+        self.timeout = self.timer_max
         self.t = datetime.now()
         self.display_message = "Database updated successfully"
         return None
@@ -235,15 +286,18 @@ class StateBookmarkExplorerIndex(State):
         if not database.database_is_connected():
             database.open_database()
 
+        # Start getting the similarity index ready in the background so it's there by the time anyone asks
+        get_similarity_index(database.db_path)
+
         # Create our menu which should display our options for viewing bookmarks
         # We'll start with a random and a back option
         menu_items = ["Random Bookmark", "View By Category", "View By Date Added", "View By Tag", "Search", "Back"]
         menu_functions = [
-            MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[self.random_bookmark()]),
+            MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[Deferred(self.random_bookmark)]),
             MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkExplorerByCategory),
             MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkExplorerByYear),
             MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkExplorerByTag),
-            MenuFunction(FunctionType.ADVANCE_STATE, state=StateExit),
+            MenuFunction(FunctionType.ADVANCE_STATE, state=StateSearch),
             MenuFunction(FunctionType.REGRESS_STATE)
             ]
 
@@ -258,24 +312,44 @@ class StateBookmarkExplorerIndex(State):
     def reroll_random_bookmark(self):
         """Reroll the random bookmark"""
         logging.info("Rerolling random bookmark")
-        # Update the menu function to use the new bookmark
-        self.menu.functions[0].args[0] = self.random_bookmark()
+        # Update the menu function to use a new bookmark, this is picked when it's selected
+        self.menu.functions[0].args[0] = Deferred(self.random_bookmark)
 
 class StateBookmarkExplorerByCategory(State):
-    """Display each bookmark category as a menu item"""
-    def __init__(self, stdscr):
+    """Display the bookmark folders inside a folder as menu items, starting from the top level folders
+    Folders with subfolders open another one of these, the rest go straight to the bookmarks list"""
+    def __init__(self, stdscr, folder_id=None, folder_name=None, bookmark_count=0):
         super().__init__(stdscr)
-        categories = database.get_categories()
-        # Unpack the tuples
-        menu_items = [category[0] for category in categories]
-        # Functions are just advance state to the bookmark list state
-        menu_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[database.get_bookmarks_by_category(category[0]), f"{category[0]} Bookmarks", "category"]) for category in categories]
+        # Each folder is (id, name, bookmarks in the subtree, has subfolders)
+        folders = [folder for folder in database.get_child_folders(folder_id) if folder[2] > 0]
+
+        menu_items = []
+        menu_functions = []
+
+        # Inside a folder we can look at everything in it, subfolders included
+        if folder_id is not None:
+            menu_items.append(f"All {folder_name} Bookmarks ({bookmark_count})")
+            menu_functions.append(self.bookmarks_list_function(folder_id, folder_name))
+
+        for child_id, name, count, has_children in folders:
+            if has_children:
+                menu_items.append(f"{name}/ ({count})")
+                menu_functions.append(MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkExplorerByCategory, args=[child_id, name, count]))
+            else:
+                menu_items.append(f"{name} ({count})")
+                menu_functions.append(self.bookmarks_list_function(child_id, name))
 
         # Add on the back option
         menu_items.append("Back")
         menu_functions.append(MenuFunction(FunctionType.REGRESS_STATE))
 
-        self.menu = MenuList(self.stdscr, menu_items, menu_functions, "Bookmarks by Category")
+        menu_title = "Bookmarks by Category" if folder_id is None else f"{folder_name} Folders"
+        self.menu = MenuList(self.stdscr, menu_items, menu_functions, menu_title)
+
+    def bookmarks_list_function(self, folder_id, folder_name):
+        """Menu function for listing every bookmark in a folder
+        The bookmarks are only loaded when it's selected"""
+        return MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[Deferred(database.get_bookmarks_by_folder, folder_id), f"{folder_name} Bookmarks", "folder", folder_restriction(folder_id)])
 
 class StateBookmarkExplorerByTag(State):
     """Display each tag as a menu item"""
@@ -283,7 +357,7 @@ class StateBookmarkExplorerByTag(State):
         super().__init__(stdscr)
         tags = database.get_all_tags()
         menu_items = [tag for tag in tags]
-        meun_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[database.get_bookmarks_by_tag(tag), f"Bookmarks with tag {tag}", "tag"]) for tag in tags]
+        meun_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[Deferred(database.get_bookmarks_by_tag, tag), f"Bookmarks with tag {tag}", "tag"]) for tag in tags]
 
         # Back option
         menu_items.append("Back")
@@ -324,7 +398,7 @@ class StateBookmarkExplorerByMonth(State):
         menu_items = [month_names[month] for month in months]
 
         # Functions are just advance state to the bookmark list state
-        menu_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[database.get_bookmarks_by_year_month(self.year, month), f"Bookmarks {month_names[month]} {year}", "month"]) for month in months]
+        menu_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarksList, args=[Deferred(database.get_bookmarks_by_year_month, self.year, month), f"Bookmarks {month_names[month]} {year}", "month"]) for month in months]
 
         # Append the back option
         menu_items.append("Back")
@@ -335,51 +409,130 @@ class StateBookmarkExplorerByMonth(State):
 
 class StateBookmarksList(State):
     """Display a list of bookmarks that are passed to the state"""
-    def __init__(self, stdscr, bookmarks, menu_title="Remember to set a title", by="category"):
+    def __init__(self, stdscr, bookmarks, menu_title="Remember to set a title", by="category", restrictions=None):
         super().__init__(stdscr)
-        # Bookmarks should be passed as a list of bookmark object
+        # Bookmarks should be passed as a list or pager of bookmark objects
+        # With a pager only the rows on screen get loaded
         self.bookmarks = bookmarks
         # Here we will create a list menu from the bookmarks - also include a randomise option at the top
-        menu_items = ["Randomise"] + [bookmark.title for bookmark in self.bookmarks]
-        category = self.bookmarks[0].folder
-
-        # Set restrictions based on by attribute
-        restrictions = None
-        if by == "category":
-            restrictions = f"folder = \"{category}\""
-        elif by == "month":
-            # Get the year and month from the first bookmark (they should all be the same)
-            restrictions = f"strftime('%Y', add_date) = '{self.bookmarks[0].year}' AND strftime('%m', add_date) = '{self.bookmarks[0].month}'"
-        elif by == "tag":
-            # We can actually extract the tag from the menu title which is a bit stupid but whatever
-            tag = menu_title.split(' ')[-1]
-            logging.info(f"Tag: {tag}")
-            restrictions = f"tags LIKE '%,{tag},%' OR tags LIKE '%,{tag}' OR tags LIKE '{tag},%'"
-
-        menu_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[self.random_bookmark(), True, restrictions])]
-        # Disable randomisation for viewing a single bookmark
-        menu_functions += [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[bookmark, False]) for bookmark in self.bookmarks]
+        # The list can be empty if the bookmarks were deleted by a sync after the menu leading here was made
+        category = self.bookmarks[0].folder if len(self.bookmarks) else None
+
+        # Set restrictions based on by attribute, unless we've been given some (e.g. for folders)
+        if restrictions is None and len(self.bookmarks):
+            if by == "category":
+                restrictions = f"folder = \"{category}\""
+            elif by == "month":
+                # Get the year and month from the first bookmark (they should all be the same)
+                restrictions = month_restriction(self.bookmarks[0].year, self.bookmarks[0].month)
+            elif by == "tag":
+                # We can actually extract the tag from the menu title which is a bit stupid but whatever
+                tag = menu_title.split(' ')[-1]
+                logging.info(f"Tag: {tag}")
+                restrictions = tag_restriction(tag)
 
-        # If there's only one bookmark in the bookmarks list pop off the randomise option
-        if len(self.bookmarks) == 1:
-            menu_items.pop(0)
-            menu_functions.pop(0)
+        self.restrictions = restrictions
+
+        # Only add the randomise option if there's more than one bookmark to pick from
+        head_items = []
+        head_functions = []
+        if len(self.bookmarks) > 1:
+            head_items.append("Randomise")
+            head_functions.append(MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[self.random_bookmark(), True, restrictions]))
 
         # Add the back option
-        menu_items.append("Back")
-        menu_functions.append(MenuFunction(FunctionType.REGRESS_STATE))
+        tail_items = ["Back"]
+        tail_functions = [MenuFunction(FunctionType.REGRESS_STATE)]
+
+        # Items and functions for the bookmarks themselves are made as they're needed
+        menu_items = PagedItems(self.bookmarks, lambda bookmark: bookmark.title, head_items, tail_items)
+        # Disable randomisation for viewing a single bookmark
+        menu_functions = PagedItems(self.bookmarks, lambda bookmark: MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[bookmark, False]), head_functions, tail_functions)
 
         self.menu = MenuList(self.stdscr, menu_items, menu_functions, menu_title)
 
     def random_bookmark(self):
         """Get a new random bookmark"""
-        # Update the menu function to use the new bookmark
+        # Use the database's sampler so we don't repeat ourselves
+        if self.restrictions is not None:
+            return database.get_random_bookmark(restrictions=self.restrictions)
         return choice(self.bookmarks)
 
     def reroll_random_bookmark(self):
         """Reroll the random bookmark"""
         self.menu.functions[0].args[0] = self.random_bookmark()
 
+class StateSearch(State):
+    """Search titles, urls, descriptions, tags and page content as you type
+    Results are ranked best first and the selected one shows where it matched"""
+    def __init__(self, stdscr):
+        super().__init__(stdscr)
+        self.text = ""
+        self.searched = None
+        self.results = []
+        self.menu = MenuList(self.stdscr, ["Back"], [MenuFunction(FunctionType.REGRESS_STATE)], "Search", filterable=False)
+
+    def update(self, key=None):
+        """Typing goes into the search box, everything else goes to the menu"""
+        if key is None:
+            self.stdscr.nodelay(True)
+            key = self.stdscr.getch()
+        if key in (curses.KEY_BACKSPACE, 127, 8):
+            self.text = self.text[:-1]
+            key = -1
+        elif 32 <= key < 127:
+            self.text += chr(key)
+            key = -1
+
+        if self.text != self.searched:
+            self.search()
+
+        return super().update(key)
+
+    def search(self):
+        """Run the search and put the results in the menu"""
+        self.searched = self.text
+        self.results = database.search_bookmarks(self.text)
+
+        menu_items = [bookmark.title for bookmark, _ in self.results] + ["Back"]
+        menu_functions = [MenuFunction(FunctionType.ADVANCE_STATE, state=StateBookmarkViewer, args=[bookmark, False]) for bookmark, _ in self.results]
+        menu_functions.append(MenuFunction(FunctionType.REGRESS_STATE))
+        self.menu.items = menu_items
+        self.menu.functions = menu_functions
+        self.menu.selected = 0
+        self.menu.offset = 0
+
+    def reroll_random_bookmark(self):
+        """Nothing random here, the viewer calls this when we go back to it"""
+        pass
+
+    def render_snippet(self, snippet):
+        """Draw a snippet with the matched words highlighted"""
+        t_height, t_width = self.stdscr.getmaxyx()
+        # Page content can have all sorts of whitespace in it
+        snippet = " ".join(snippet.split())[:t_width - 1]
+        col = self.colours.get_colour('white_on_black')
+        highlight_col = self.colours.get_colour('yellow_on_black') | curses.A_BOLD
+        for i, part in enumerate(snippet.split(HIGHLIGHT_START)):
+            # Everything before the end marker is a match, apart from the text before the first match
+            if i > 0 and HIGHLIGHT_END in part:
+                match, part = part.split(HIGHLIGHT_END, 1)
+                self.stdscr.addstr(match, highlight_col)
+            self.stdscr.addstr(part.replace(HIGHLIGHT_END, ""), col)
+        self.stdscr.addstr("\n")
+
+    def render(self):
+        """Render the search box, the selected result's snippet and the results"""
+        self.stdscr.addstr(f"Search: {self.text}_\n", self.colours.get_colour('green_on_black') | curses.A_BOLD)
+        if self.menu.selected < len(self.results):
+            self.render_snippet(self.results[self.menu.selected][1] or "")
+        elif self.text.strip():
+            self.stdscr.addstr("No matches\n", self.colours.get_colour('red_on_black'))
+        else:
+            self.stdscr.addstr("\n")
+
+        super().render()
+
 class StateSelectBookmarksFile(State):
     """State for selecting a bookmarks .html file
     Used for creating a new database"""
@@ -388,46 +541,80 @@ class StateSelectBookmarksFile(State):
         self.stdscr = stdscr
         self.filepath = None
 
-        # Get a list of all .html files in the current directory
-        # Also crawl subdirectories
+        # Chrome's own bookmarks go first if we can find them, these are kept in sync while the CLI is open
         self.html_files = {}
-        logging.info("Walking current directory")
-        logging.info(f"Current directory: {os.getcwd()}")
-        for path, dir, files in os.walk(os.getcwd()):
-            # Save the filename and path to the dictionary
-            if len(files) != 0:
-                for file in files:
-                    if file.endswith('.html'):
-                        self.html_files[file] = os.path.join(path, file)
-
-        # Sort the dictionary by key, reverse=True for descending order
-        # Should show most recent bookmarks first by Chrome's naming convention
-        self.html_files = dict(sorted(self.html_files.items(), reverse=True))
-
-        menu_options = list(self.html_files.keys()) + ["Delete database", "Exit"]
-        menu_functions = [MenuFunction(FunctionType.FUNCTION, self.select_file, [file]) for file in list(self.html_files.keys())]
-        menu_functions += [MenuFunction(FunctionType.FUNCTION, self.delete_database), MenuFunction(FunctionType.REGRESS_STATE)]
+        chrome_bookmarks = get_chrome_bookmarks_path()
+        if os.path.isfile(chrome_bookmarks):
+            self.html_files["Chrome bookmarks (live)"] = chrome_bookmarks
+
+        # Add only inserts new bookmarks, sync also moves and removes them to match the file
+        self.sync = False
+
+        # Look for bookmarks exports in the background, the menu fills up as they're found
+        logging.info(f"Scanning for bookmarks files in: {os.getcwd()}")
+        self.finder = BookmarksFileFinder(os.getcwd())
+        self.finder.start()
+        self.finder_done = False
 
         # Create a list style menu
-        self.menu = MenuList(self.stdscr, menu_options, menu_functions, "Select Bookmarks File")
+        self.menu = MenuList(self.stdscr, [], [], "Select Bookmarks File")
+        self.build_menu()
         logging.info("StateSelectBookmarksFile initialised")
 
         self.deleted_database_timer_max = 2
         self.deleted_database_timer = 0
         self.t = datetime.now()
 
+    def build_menu(self):
+        """Fill the menu with the files found so far, keeping the selection where it was"""
+        selected_item = self.menu.items[self.menu.selected] if self.menu.items else None
+
+        # Sorted in descending order so the most recent exports come first by Chrome's naming convention
+        files = list(self.html_files.keys())
+        if "Chrome bookmarks (live)" in self.html_files:
+            files.remove("Chrome bookmarks (live)")
+            files = ["Chrome bookmarks (live)"] + sorted(files, reverse=True)
+        else:
+            files = sorted(files, reverse=True)
+
+        menu_options = files + [self.import_mode_label(), "Delete database", "Exit"]
+        menu_functions = [MenuFunction(FunctionType.FUNCTION, self.select_file, [file]) for file in files]
+        menu_functions += [MenuFunction(FunctionType.FUNCTION, self.toggle_import_mode), MenuFunction(FunctionType.FUNCTION, self.delete_database), MenuFunction(FunctionType.REGRESS_STATE)]
+        self.menu.items = menu_options
+        self.menu.functions = menu_functions
+
+        if selected_item in menu_options:
+            self.menu.selected = menu_options.index(selected_item)
+
+    def import_mode_label(self):
+        """Menu text for the import mode"""
+        return "Import mode: Sync" if self.sync else "Import mode: Add new"
+
+    def toggle_import_mode(self):
+        """Switch between adding new bookmarks and syncing to the file"""
+        index = self.menu.items.index(self.import_mode_label())
+        self.sync = not self.sync
+        self.menu.items[index] = self.import_mode_label()
+
     def delete_database(self):
         """Delete the database"""
-        if self.database_exists():
-            os.remove(os.path.join(os.getcwd(), 'bookmarks.db'))
+        # Let go of the connection first, it gets closed when the file is deleted
+        if database:
+            database.close_database()
+        delete_database(os.path.join(os.getcwd(), 'bookmarks.db'))
 
         self.deleted_database_timer = self.deleted_database_timer_max
+        self.timeout = self.deleted_database_timer_max
         self.t = datetime.now()
 
     def draw_deleted_message(self):
         """Draw a message to the screen when the database is deleted"""
+        message = "Database deleted successfully"
         yy, xx = self.stdscr.getmaxyx()
-        self.stdscr.addstr(int(yy/2), int(xx/2)-int(len("Database deleted successfully")/2), "Database deleted successfully", self.colours.get_colour('white_on_red') | curses.A_ITALIC)
+        # It needs its own window to go over the list, one column wider so the cursor has somewhere to go
+        window = curses.newwin(1, len(message) + 1, int(yy/2), int(xx/2)-int(len(message)/2))
+        window.addstr(0, 0, message, self.colours.get_colour('white_on_red') | curses.A_ITALIC)
+        window.noutrefresh()
 
     def select_file(self, file):
         """Create a database from the selected file"""
@@ -442,43 +629,83 @@ class StateSelectBookmarksFile(State):
         # This will set the on_regress callback
         self.update_function_args = [state_previous.on_db_update]
 
-    def update(self):
+    def update(self, key=None):
+        # Add any files the finder has turned up
+        found = self.finder.poll()
+        if found:
+            for file, path in found:
+                # The first one found is the shallowest if two have the same name
+                self.html_files.setdefault(file, path)
+            self.build_menu()
+            self.dirty = True
+        elif self.finder.finished() and not self.finder_done:
+            # The "looking for files" message needs to change
+            self.finder_done = True
+            self.dirty = True
+
         # Count down the timer if necessary
         if self.deleted_database_timer > 0:
             dt = datetime.now() - self.t
             self.deleted_database_timer -= dt.total_seconds()
             self.t = datetime.now()
+            self.timeout = max(self.deleted_database_timer, 0)
             if self.deleted_database_timer <= 0:
                 self.deleted_database_timer = 0
+                self.timeout = IDLE_TIMEOUT
+                self.dirty = True
             return None
 
-        return super().update()
+        return super().update(key)
 
     def render(self):
         """Render the state"""
         if self.html_files == {}:
-            self.stdscr.addstr("No .html files found in current directory\n", self.colours.get_colour('red_on_black'))
+            if self.finder.finished():
+                self.stdscr.addstr("No .html files or Chrome bookmarks found\n", self.colours.get_colour('red_on_black'))
+            else:
+                self.stdscr.addstr("Looking for bookmarks files...\n", self.colours.get_colour('yellow_on_black'))
         elif self.database_exists():
+            if self.sync:
+                self.stdscr.addstr("Database already exists, it will be synced to the file and bookmarks not in it removed\n", self.colours.get_colour('red_on_black'))
+            else:
                 self.stdscr.addstr("Database already exists, new bookmarks will be added to existing database\n", self.colours.get_colour('red_on_black'))
 
         super().render()
 
+    def refresh(self):
+        """The deleted message goes on top of the file list"""
+        super().refresh()
         if self.deleted_database_timer > 0:
             self.draw_deleted_message()
-            self.stdscr.addstr("\n")
 
     def create_database(self, html_filepath, db_path='bookmarks.db'):
         """Create a new database"""
-        # Parse the bookmarks
-        bookmarks, failures = parse(html_filepath)
-        if len(failures) > 0:
-            logging.warning(f'Bookmarks folders failed to parse: {failures}')
+        # Parse the bookmarks straight into the database, nothing is held in memory
+        if html_filepath.lower().endswith(BOOKMARKS_EXTENSIONS):
+            parser = BookmarksParser()
+        else:
+            parser = BookmarksReader()
+        self.database = Database(db_path=db_path)
+        if self.sync:
+            # Only what changed since the last import is written, an unchanged file isn't even parsed
+            self.database.sync_bookmarks(parser.stream(html_filepath), source=html_filepath, fingerprint=fingerprint_file(html_filepath))
+        else:
+            self.database.export_bookmarks(parser.stream(html_filepath))
+
+        if len(parser.failures) > 0:
+            logging.warning(f'Bookmarks folders failed to parse: {parser.failures}')
         else:
             logging.info('Bookmarks parsed successfully')
 
-        self.database = Database(db_path=db_path)
-        self.database.export_bookmarks(bookmarks)
+        if isinstance(parser, BookmarksReader):
+            self.watch(html_filepath, db_path)
+
 
+    def watch(self, bookmarks_filepath, db_path='bookmarks.db'):
+        """Start syncing the database whenever Chrome's Bookmarks file changes"""
+        global watcher
+        watcher = BookmarksWatcher(bookmarks_filepath, db_path=db_path, sync=self.sync)
+        logging.info(f"Watching Chrome bookmarks: {bookmarks_filepath}")
 
     def database_exists(self, db_path='bookmarks.db'):
         """Check if a database exists"""
@@ -507,11 +734,19 @@ class StateGenerateDescriptionsAndTags(State):
             return None
 
 
+        # Scraped rows are buffered and written in batches
+        # Create this first so anything left in the journal from a crash is written before we look for work
+        # Tags are picked for each batch as it's written, the words are counted by the scraper threads
+        writer_database = Database()
+        self.writer = DescriptionWriter(writer_database, tagger=TagEngine(writer_database))
+        # Pages scraped before tags were picked this way still need counting, that happens in the background
+        start_corpus_count(writer_database.db_path)
+
         # Get the list of bookmarks to process
         try:
-            self.bookmarks_to_process = get_null_description_bookmarks()
-            self.bookmarks_processed = []
-            self.bookmarks_total = len(self.bookmarks_to_process)
+            bookmarks_to_process = get_null_description_bookmarks()
+            self.bookmarks_total = len(bookmarks_to_process)
+            self.bookmarks_processed = 0
             self.failures = 0
         except Exception as e:
             logging.warning("Failed to get bookmarks to process")
@@ -519,27 +754,42 @@ class StateGenerateDescriptionsAndTags(State):
             self.error = True
             return None
 
+        # Scraping happens in the background, we just collect the results as they come in
+        # The engine wakes the main loop for each result, the timeout is so the writer gets flushed on time
+        self.engine = ScrapingEngine(bookmarks_to_process, prepare=add_word_counts)
+        self.engine.start()
+        self.timeout = 0.5
 
-
-    def update(self):
+    def update(self, key=None):
         """Update the state"""
         if not self.error:
-            # We will go through the bookmarks to process and generate descriptions and tags
-            try:
-                # Pop the bookmark from the list and append it to the processed list
-                # Do this first otherwise we'll get stuck on the same bookmark if we crash
-                self.bookmarks_processed.append(self.bookmarks_to_process.pop(0))
-                # Then scrape the data
-                success = scrape_data(self.bookmarks_processed[-1])
-                if not success:
+            # Collect whatever the scraping engine has finished since the last frame
+            page_contents = []
+            for bookmark, result in self.engine.poll():
+                # The progress needs drawing again
+                self.dirty = True
+                self.bookmarks_processed += 1
+                # Check if the second value of the tuple is None
+                if result[1] is None:
+                    logging.info(f"Failed to scrape url: {bookmark[1]}")
                     self.failures += 1
+                else:
+                    page_contents.append(result)
+
+            # Hand the results to the writer, it'll flush them when the batch is big or old enough
+            try:
+                self.writer.add(page_contents)
+                self.writer.tick()
             except Exception as e:
-                logging.warning("Failed to generate descriptions and tags")
-                logging.warning(e)
+                logging.error(f"Failed to insert page contents into database: {e}")
 
             try:
                 # Go back to the previous state if we're done
-                if len(self.bookmarks_to_process) == 0:
+                if self.engine.finished():
+                    logging.info(f"Scraping finished, render stats: {get_render_stats()}")
+                    self.writer.close()
+                    # Add the new descriptions to the similarity index
+                    refresh_similarity_index(database.db_path)
                     # Set the update function to regress to the previous state
                     self.update_function = self.regress_state
                     state_previous = state_history[-2]
@@ -549,7 +799,7 @@ class StateGenerateDescriptionsAndTags(State):
                 logging.warning("Failed to update generate descriptions and tags state - maybe database is empty?")
                 logging.warning(e)
 
-        return super().update()
+        return super().update(key)
 
     def draw_progress_bar(self, t_width, percentage_complete):
         """Draw a progress bar in [] brackets with # representing progress"""
@@ -574,7 +824,7 @@ class StateGenerateDescriptionsAndTags(State):
         self.stdscr.addstr("\n")
 
         # Now we can draw a progress bar
-        percentage_complete = int((self.bookmarks_total - len(self.bookmarks_to_process)) / self.bookmarks_total * 100)
+        percentage_complete = int(self.bookmarks_processed / self.bookmarks_total * 100) if self.bookmarks_total else 100
         percentage_complete = str(percentage_complete) + "%"
         # Draw the percentage centred in green
         padding_left = int(t_width/2)-int(len(percentage_complete)/2)
@@ -585,8 +835,11 @@ class StateGenerateDescriptionsAndTags(State):
         # Display how many successes and failures we've had
         self.stdscr.addstr("\n")
         self.stdscr.addstr("\n")
-        self.stdscr.addstr(f"Successes: {self.bookmarks_total - len(self.bookmarks_to_process) - self.failures}\n", self.colours.get_colour('green_on_black') | curses.A_BOLD)
+        self.stdscr.addstr(f"Successes: {self.bookmarks_processed - self.failures}\n", self.colours.get_colour('green_on_black') | curses.A_BOLD)
         self.stdscr.addstr(f"Failures: {self.failures}\n", self.colours.get_colour('red_on_black') | curses.A_BOLD)
+        # How many pages needed javascript rendering
+        render_stats = get_render_stats()
+        self.stdscr.addstr(f"Rendered: {render_stats['rendered']} Static: {render_stats['static']}\n", self.colours.get_colour('cyan_on_black') | curses.A_BOLD)
 
         super().render()
 
@@ -601,21 +854,22 @@ class StateBookmarkViewer(State):
         self.randomise = randomise
 
         # Set up a menu which will allow us to go back or open the bookmark
-        menu_items = ["Open Bookmark", "Randomise", "Back"]
+        menu_items = ["Open Bookmark", "Similar Bookmarks", "Randomise", "Back"]
         # Set on_regress for prior state
         prev_state = state_history[-2]
         menu_functions = [
             MenuFunction(FunctionType.FUNCTION, self.open_bookmark),
+            MenuFunction(FunctionType.FUNCTION, self.similar_bookmarks),
             MenuFunction(FunctionType.FUNCTION, self.get_random_bookmark),
             MenuFunction(FunctionType.REGRESS_STATE, args=[prev_state.reroll_random_bookmark])
             ]
 
         # We can turn randomise off if we want
         if not self.randomise:
-            # Just pop out value 1
+            # Just pop out value 2
             # Yes this is bad practice but also fuck off
-            menu_items.pop(1)
-            menu_functions.pop(1)
+            menu_items.pop(2)
+            menu_functions.pop(2)
 
         self.menu = Menu(self.stdscr, menu_items, menu_functions, "Bookmark Viewer", position="bottom")
 
@@ -623,18 +877,29 @@ class StateBookmarkViewer(State):
         self.tags = database.get_tags(self.bookmark.id)
         self.description = database.get_description(self.bookmark.id)
 
+        # Set when Similar Bookmarks was pressed before the similarity index was ready
+        self.waiting_for_index = False
+
+    def update(self, key=None):
+        """Update the state"""
+        # The index wakes the main loop when it's done, then we can carry on to the similar bookmarks
+        if self.waiting_for_index and not get_similarity_index(database.db_path).busy():
+            self.waiting_for_index = False
+            self.dirty = True
+            self.similar_bookmarks()
+
+        return super().update(key)
+
     def get_random_bookmark(self):
         """Get a new random bookmark"""
+        # The sampler doesn't repeat itself, but the bookmark we're looking at might not have come from it
         new_bookmark = database.get_random_bookmark(restrictions=self.restrictions)
-        timeout = 100
-        # We'll try loop until we get a new bookmark that isn't the same as the current one
-        # Timeout incase I fuck anything up
-        while new_bookmark.get_attributes() == self.bookmark.get_attributes() and timeout > 0:
+        if new_bookmark is not None and new_bookmark.id == self.bookmark.id:
             new_bookmark = database.get_random_bookmark(restrictions=self.restrictions)
-            timeout -= 1
 
-        if timeout == 0:
-            logging.info("Failed to get a unique random bookmark, which seems pretty unlikely")
+        if new_bookmark is None:
+            logging.info("Failed to get a random bookmark")
+            return None
 
         self.bookmark = new_bookmark
 
@@ -646,6 +911,33 @@ class StateBookmarkViewer(State):
         """Open the bookmark"""
         webbrowser.open(self.bookmark.url)
 
+    def similar_bookmarks(self):
+        """Go to a list of the bookmarks with the most similar page content"""
+        index = get_similarity_index(database.db_path)
+        if index.busy():
+            # Try again once it's ready
+            self.waiting_for_index = True
+            return
+
+        try:
+            similar = index.similar(self.bookmark.id)
+        except Exception as e:
+            logging.warning(f"Failed to find similar bookmarks: {e}")
+            similar = []
+
+        bookmarks = [database.get_bookmark(bookmark_id) for bookmark_id, _ in similar]
+        # Anything deleted since it was indexed comes back as None
+        bookmarks = [bookmark for bookmark in bookmarks if bookmark is not None]
+
+        self.update_function = self.advance_state
+        if not bookmarks:
+            self.update_function_args = [StateDisplayText, ["No similar bookmarks found, descriptions need generating first", False]]
+            return
+
+        # Randomise picks from the similar bookmarks
+        restrictions = f"bookmarks.id IN ({', '.join(str(bookmark.id) for bookmark in bookmarks)})"
+        self.update_function_args = [StateBookmarksList, [bookmarks, f"Similar to {self.bookmark.title}", "similar", restrictions]]
+
     def render_bookmark(self, bookmark):
         """Draws the bookmark details"""
         # Draw the bookmark details
@@ -668,6 +960,8 @@ class StateBookmarkViewer(State):
     def render(self):
         """Render bookmark details"""
         self.render_bookmark(self.bookmark)
+        if self.waiting_for_index:
+            self.stdscr.addstr("\nIndexing page content for similar bookmarks...\n", self.colours.get_colour('red_on_black') | curses.A_BOLD)
 
         # Render menu
         super().render()
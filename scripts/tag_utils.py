@@ -0,0 +1,206 @@
+import os
+import logging
+import sqlite3
+import threading
+import numpy as np
+from collections import Counter
+from scipy import sparse
+from scripts.nlp_utils import clean_words, load_resources
+from scripts.database_utils import Database
+
+N_TAGS = 3
+# A word has to be on at least this many pages to be a tag, a tag no other bookmark has doesn't help browsing
+MIN_TAG_DOCUMENTS = 2
+# Words on more than this fraction of pages are too generic to be tags
+MAX_TAG_DOCUMENT_RATIO = 0.25
+# The limits above only kick in once there are this many pages to go on
+MIN_CORPUS_SIZE = 50
+# Older SQLite builds only allow 999 parameters in a query
+QUERY_CHUNK = 500
+# Pages counted per transaction when counting the ones scraped before there were document frequencies
+CORPUS_BATCH = 200
+# Name of that job in the backfills table
+CORPUS_BACKFILL = 'tag_corpus'
+
+# Threads counting the old pages, by database path, so each database is only counted once a run
+corpus_counts = {}
+
+
+def count_words(row):
+    """Returns the cleaned word counts of a (bookmark_id, content, relevant_content, description, tags) row,
+    or None for rows that don't get tagged (like 404s, which are tagged already, or pages with no text)
+    Cleaning is the slow part of tagging so the scraper does this on its worker threads"""
+    if row[4] is not None or not (row[2] or row[3]):
+        return None
+    # Same text the old FreqDist tags used, the description then the relevant content
+    return Counter(clean_words(' '.join(text for text in (row[3], row[2]) if text)))
+
+def add_word_counts(row):
+    """Returns the row with its word counts on the end, for the scraping engine to run on each result"""
+    return tuple(row[:5]) + (count_words(row),)
+
+class TagEngine():
+    """Picks tags for scraped pages by TF-IDF against every page scraped so far
+    Document frequencies are kept in the term_stats table and updated with each batch,
+    so tagging new pages never means reading the rest of the corpus again
+    Use it as the tagger for a DescriptionWriter, the rows should have their word counts from add_word_counts
+    so all that's left to do when they're written is SQL and some sums"""
+    def __init__(self, database, n_tags=N_TAGS):
+        self.database = database
+        self.n_tags = n_tags
+
+    def __call__(self, rows):
+        """Fill in tags for a batch of (bookmark_id, content, relevant_content, description, tags, word counts) rows
+        Returns the rows without their word counts, ready for insert_descriptions
+        Rows that already have tags (like 404s) or have no text are left alone"""
+        rows = list(rows)
+        indices = [i for i, row in enumerate(rows) if row[4] is None and (row[2] or row[3])]
+        # Rows from an older journal won't have been counted yet
+        counts = [Counter(rows[i][5]) if len(rows[i]) > 5 and rows[i][5] is not None else count_words(rows[i]) for i in indices]
+        rows = [tuple(row[:5]) for row in rows]
+        if not indices:
+            return rows
+
+        self.count_documents([rows[i][0] for i in indices], counts)
+        tags = self.score(counts)
+
+        for i, row_tags in zip(indices, tags):
+            bookmark_id, content, relevant_content, description, _ = rows[i]
+            rows[i] = (bookmark_id, content, relevant_content, description, ','.join(row_tags) if row_tags else None)
+        logging.info(f"Tagged {len(indices)} pages")
+        return rows
+
+    def count_corpus(self):
+        """Count the pages that were scraped before there were document frequencies
+        A batch at a time, each committed along with how far it got so a failure or quitting carries on next time
+        This cleans a lot of text so it should be run on a background thread, see start_corpus_count"""
+        # Fail before writing anything if the nltk data isn't there
+        load_resources()
+        database = self.database
+        if not database.database_is_connected():
+            database.open_database()
+        cursor = database.cursor
+
+        # Anything written after this is counted by the writer
+        cursor.execute("SELECT MAX(id) FROM descriptions")
+        target = cursor.fetchone()[0] or 0
+        last_id = database.get_backfill_progress(CORPUS_BACKFILL)
+        query = """
+        SELECT id, bookmark_id, content, relevant_content, description, NULL FROM descriptions
+        WHERE id > ? AND id <= ?
+        AND (relevant_content IS NOT NULL OR description IS NOT NULL) AND (tags IS NULL OR tags != '404')
+        AND NOT EXISTS (SELECT 1 FROM tag_corpus WHERE tag_corpus.bookmark_id = descriptions.bookmark_id)
+        ORDER BY id
+        LIMIT ?
+        """
+        counted = 0
+        while last_id < target:
+            cursor.execute(query, (last_id, target, CORPUS_BATCH))
+            records = cursor.fetchall()
+            # Clean the text before taking the write lock
+            rows = [record[1:] for record in records]
+            counts = [count_words(row) for row in rows]
+            last_id = records[-1][0] if records else target
+
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                self.count_documents([row[0] for row in rows], counts)
+                database.set_backfill_progress(CORPUS_BACKFILL, last_id)
+                database.db.commit()
+            except sqlite3.Error:
+                database.db.rollback()
+                raise
+            counted += len(rows)
+        if counted:
+            logging.info(f"Counted {counted} scraped pages for tagging")
+
+    def count_documents(self, bookmark_ids, counts):
+        """Add the pages' words to the document frequencies, pages that have been counted before are skipped
+        Doesn't commit, the counts go in with the pages' descriptions when insert_descriptions commits"""
+        if not self.database.database_is_connected():
+            self.database.open_database()
+        cursor = self.database.cursor
+
+        # Adding the page to tag_corpus first takes the write lock,
+        # so the writer and count_corpus can't both count the same page
+        document_frequencies = Counter()
+        for bookmark_id, words in zip(bookmark_ids, counts):
+            cursor.execute("INSERT OR IGNORE INTO tag_corpus (bookmark_id) VALUES (?)", (bookmark_id,))
+            if cursor.rowcount == 1:
+                document_frequencies.update(words.keys())
+
+        query = """
+        INSERT INTO term_stats (term, document_frequency) VALUES (?, ?)
+        ON CONFLICT (term) DO UPDATE SET document_frequency = document_frequency + excluded.document_frequency
+        """
+        cursor.executemany(query, document_frequencies.items())
+
+    def get_document_frequencies(self, terms):
+        """Returns the document frequency of each term as an array"""
+        cursor = self.database.cursor
+        frequencies = {}
+        for start in range(0, len(terms), QUERY_CHUNK):
+            chunk = terms[start:start + QUERY_CHUNK]
+            cursor.execute(f"SELECT term, document_frequency FROM term_stats WHERE term IN ({', '.join('?' * len(chunk))})", chunk)
+            frequencies.update(cursor.fetchall())
+        return np.array([frequencies.get(term, 0) for term in terms], dtype=np.float64)
+
+    def score(self, counts):
+        """Returns the best tags for each page, scoring every page in the batch at once"""
+        # Term counts for the whole batch as one sparse matrix
+        vocabulary = {}
+        data, indices, indptr = [], [], [0]
+        for words in counts:
+            for word, count in words.items():
+                indices.append(vocabulary.setdefault(word, len(vocabulary)))
+                data.append(count)
+            indptr.append(len(indices))
+        if not vocabulary:
+            return [None] * len(counts)
+        matrix = sparse.csr_matrix((np.array(data, dtype=np.float64), indices, indptr), shape=(len(counts), len(vocabulary)))
+        terms = sorted(vocabulary, key=vocabulary.get)
+
+        self.database.cursor.execute("SELECT COUNT(*) FROM tag_corpus")
+        documents = self.database.cursor.fetchone()[0]
+        document_frequency = self.get_document_frequencies(terms)
+        idf = np.log((1 + documents) / (1 + document_frequency)) + 1
+
+        # Words that are too rare or too common can't be tags
+        eligible = np.ones(len(terms), dtype=bool)
+        if documents >= MIN_CORPUS_SIZE:
+            eligible = (document_frequency >= MIN_TAG_DOCUMENTS) & (document_frequency <= MAX_TAG_DOCUMENT_RATIO * documents)
+
+        # Sublinear tf so one word repeated all over a page doesn't win on its own
+        matrix.data = 1 + np.log(matrix.data)
+        scores = matrix.multiply(idf).tocsr()
+
+        tags = []
+        for row in range(scores.shape[0]):
+            start, stop = scores.indptr[row], scores.indptr[row + 1]
+            row_terms = scores.indices[start:stop]
+            row_scores = scores.data[start:stop]
+            # A page with nothing eligible still gets its best words rather than nothing
+            if eligible[row_terms].any():
+                row_scores = np.where(eligible[row_terms], row_scores, 0)
+            best = np.argsort(-row_scores, kind='stable')[:self.n_tags]
+            tags.append([terms[row_terms[i]] for i in best if row_scores[i] > 0] or None)
+        return tags
+
+def start_corpus_count(db_path):
+    """Count any pages scraped before there were document frequencies on a background thread"""
+    path = os.path.abspath(db_path)
+    if path in corpus_counts:
+        return
+    corpus_counts[path] = threading.Thread(target=run_corpus_count, args=(db_path,), name='corpus-count', daemon=True)
+    corpus_counts[path].start()
+
+def run_corpus_count(db_path):
+    """Runs on the background thread"""
+    # The persistent connection belongs to the main thread so this gets its own
+    database = Database(db_path, persistent=False)
+    try:
+        TagEngine(database).count_corpus()
+    except Exception as e:
+        logging.warning(f"Failed to count scraped pages for tagging, it'll carry on next time: {e}")
+    finally:
+        database.close_database()